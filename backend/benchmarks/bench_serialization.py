@@ -0,0 +1,142 @@
+# Before/after benchmark for response serialization and compression on
+# representative payloads (a fully generated blueprint and a chat history page).
+#
+#   cd backend && python -m benchmarks.bench_serialization [--iterations 500] [--json out.json]
+import argparse
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WORDS = (
+    "founders market category customers pricing growth retention channel strategy positioning "
+    "offer workflow automation revenue expansion partners ecosystem onboarding pipeline insight "
+    "brand audience content product experience scale leadership metrics funnel cohort margin"
+).split()
+
+LAYER_FIELDS = {
+    "identity": ["worldview", "category_pov", "brand_archetype", "core_message", "values"],
+    "product": ["main_offer", "pricing_strategy", "ten_x_feature", "signature_experience"],
+    "audience": ["target_audience", "distribution_channels", "content_strategy", "growth_engine"],
+    "systems": ["crm_approach", "automation_priorities", "key_workflows", "tech_stack"],
+    "financial": ["revenue_model", "pricing_tiers", "key_metrics", "financial_projections"],
+    "expansion": ["partnership_opportunities", "ecosystem_vision", "scale_map", "category_leadership"],
+}
+
+
+def prose(rng, sentences):
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(12, 24))).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+
+def make_blueprint(rng):
+    now = datetime.now(timezone.utc)
+    layers = []
+    for layer_id, fields in LAYER_FIELDS.items():
+        content = {}
+        for field in fields:
+            if field.endswith(("s", "map")) and rng.random() < 0.5:
+                content[field] = [prose(rng, 1) for _ in range(rng.randint(3, 5))]
+            else:
+                content[field] = prose(rng, rng.randint(2, 5))
+        layers.append({
+            "layer_id": layer_id,
+            "layer_name": f"{layer_id.title()} Layer",
+            "status": "completed",
+            "progress_percent": 100,
+            "content": content,
+            "updated_at": now.isoformat(),
+        })
+    return {
+        "blueprint_id": "bp_0123456789ab",
+        "user_id": "user_0123456789ab",
+        "company_name": "Acme Dental SaaS",
+        "layers": layers,
+        "version": 42,
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+    }
+
+
+def make_chat_page(rng, size=50):
+    start = datetime.now(timezone.utc) - timedelta(hours=size)
+    return {
+        "messages": [
+            {
+                "message_id": f"msg_{i:012d}",
+                "user_id": "user_0123456789ab",
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": prose(rng, 1 if i % 2 == 0 else rng.randint(6, 14)),
+                "created_at": start + timedelta(minutes=i),
+            }
+            for i in range(size)
+        ],
+        "has_more": True,
+        "before": "cursor",
+        "after": "cursor",
+    }
+
+
+def timed(fn, iterations):
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        result = fn()
+    return (time.perf_counter() - started) / iterations * 1e6, result
+
+
+def bench_payload(name, payload, iterations):
+    rows = []
+    # Before: FastAPI's default path (jsonable_encoder, then json.dumps)
+    before_us, body = timed(lambda: JSONResponse(jsonable_encoder(payload)).body, iterations)
+    rows.append({"payload": name, "step": "serialize", "variant": "jsonable_encoder+json", "us": before_us, "bytes": len(body)})
+    if orjson is not None:
+        after_us, body = timed(lambda: orjson.dumps(payload), iterations)
+        rows.append({"payload": name, "step": "serialize", "variant": "orjson", "us": after_us, "bytes": len(body)})
+
+    compress_iterations = max(1, iterations // 5)
+    gzip_us, gz = timed(lambda: zlib.compress(body, 6, wbits=31), compress_iterations)
+    rows.append({"payload": name, "step": "compress", "variant": "gzip-6", "us": gzip_us, "bytes": len(gz)})
+    if brotli is not None:
+        br_us, br = timed(lambda: brotli.compress(body, quality=4), compress_iterations)
+        rows.append({"payload": name, "step": "compress", "variant": "brotli-4", "us": br_us, "bytes": len(br)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = bench_payload("blueprint", make_blueprint(rng), args.iterations)
+    rows += bench_payload("chat_history_50", make_chat_page(rng), args.iterations)
+
+    print(f"{'payload':<18}{'step':<11}{'variant':<24}{'time (us)':>12}{'bytes':>10}")
+    for row in rows:
+        print(f"{row['payload']:<18}{row['step']:<11}{row['variant']:<24}{row['us']:>12.1f}{row['bytes']:>10}")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"seed": args.seed, "iterations": args.iterations, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# OpenAI-compatible stand-in for load tests. Serves /v1/chat/completions with
+# configurable latency, streaming pace and failure rate, so runs measure the
+# backend rather than the provider.
+#
+#   cd backend && python -m benchmarks.fake_openai --port 8765 --latency 0.8 --jitter 0.2
+#
+# Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1.
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "founders market category customers pricing growth retention channel strategy positioning "
+    "offer workflow automation revenue expansion partners ecosystem onboarding pipeline insight"
+).split()
+
+
+class FakeSettings:
+    def __init__(self, latency=0.5, jitter=0.1, chunk_delay=0.01, chunk_size=16, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency=float(os.environ.get("FAKE_OPENAI_LATENCY", "0.5")),
+            jitter=float(os.environ.get("FAKE_OPENAI_JITTER", "0.1")),
+            chunk_delay=float(os.environ.get("FAKE_OPENAI_CHUNK_DELAY", "0.01")),
+            chunk_size=int(os.environ.get("FAKE_OPENAI_CHUNK_SIZE", "16")),
+            error_rate=float(os.environ.get("FAKE_OPENAI_ERROR_RATE", "0")),
+        )
+
+    def delay(self):
+        return max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+    def prose(self, words):
+        return " ".join(self.rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def completion_text(settings, body):
+    system = next((m["content"] for m in body.get("messages", []) if m.get("role") == "system"), "")
+    if "JSON" in system:
+        return json.dumps({
+            "summary": settings.prose(40),
+            "key_points": [settings.prose(12) for _ in range(4)],
+            "next_steps": [settings.prose(10) for _ in range(3)],
+        })
+    return " ".join(settings.prose(14) for _ in range(5))
+
+
+def usage_for(body, text):
+    prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 4
+    completion_tokens = len(text) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+def create_app(settings=None):
+    settings = settings or FakeSettings.from_env()
+    app = FastAPI()
+    app.state.settings = settings
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        settings.calls += 1
+        await asyncio.sleep(settings.delay())
+        if settings.error_rate and settings.rng.random() < settings.error_rate:
+            settings.errors += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                status_code=429,
+                headers={"retry-after": "0.5"}
+            )
+
+        text = completion_text(settings, body)
+        created = int(time.time())
+        if not body.get("stream"):
+            return {
+                "id": f"chatcmpl-{settings.calls}",
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model", "fake"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage_for(body, text),
+            }
+
+        async def chunks():
+            base = {"id": f"chatcmpl-{settings.calls}", "object": "chat.completion.chunk", "created": created, "model": body.get("model", "fake")}
+            for i in range(0, len(text), settings.chunk_size):
+                await asyncio.sleep(settings.chunk_delay)
+                delta = {"content": text[i:i + settings.chunk_size]}
+                yield f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n"
+            yield f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps({**base, 'choices': [], 'usage': usage_for(body, text)})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": settings.calls, "errors": settings.errors}
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = FakeSettings(args.latency, args.jitter, args.chunk_delay, error_rate=args.error_rate)
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
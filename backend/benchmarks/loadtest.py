@@ -0,0 +1,442 @@
+# End-to-end load test for server.py against local stand-ins: an in-memory
+# MongoDB (mongomock-motor) or a local mongod, and the fake OpenAI server from
+# benchmarks/fake_openai.py. Drives a weighted mix of the main user routes and
+# reports throughput, latency percentiles and event loop lag per run.
+#
+#   cd backend && python -m benchmarks.loadtest --duration 30 --concurrency 32
+#   cd backend && python -m benchmarks.loadtest --mongo mongodb://localhost:27017 --mix ai_heavy
+#   cd backend && python -m benchmarks.loadtest --baseline benchmarks/results/<earlier>.json
+#   cd backend && python -m benchmarks.loadtest --diff OLD.json NEW.json
+#
+# Each run is written to benchmarks/results/ so later runs can be compared
+# against it; --fail-on-regression exits non-zero when p95 gets worse by more
+# than --threshold percent on any route.
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+LAYER_IDS = ["identity", "product", "audience", "systems", "financial", "expansion"]
+
+# Relative weights per operation
+MIXES = {
+    "default": {
+        "auth_me": 20, "get_blueprint": 30, "update_layer": 15,
+        "mentor_chat": 10, "generate_layer": 10, "export_pdf": 5,
+    },
+    "read_heavy": {
+        "auth_me": 35, "get_blueprint": 50, "update_layer": 5,
+        "mentor_chat": 3, "generate_layer": 2, "export_pdf": 5,
+    },
+    "ai_heavy": {
+        "auth_me": 10, "get_blueprint": 15, "update_layer": 10,
+        "mentor_chat": 30, "generate_layer": 30, "export_pdf": 5,
+    },
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 2) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ============== STAND-INS ==============
+
+def start_fake_openai(args):
+    port = free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.fake_openai", "--port", str(port),
+            "--latency", str(args.llm_latency), "--jitter", str(args.llm_jitter),
+            "--error-rate", str(args.llm_error_rate),
+        ],
+        cwd=BACKEND_DIR
+    )
+    wait_for_port(port)
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def wait_for_port(port, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+class AppServer:
+    # Runs server.app under uvicorn on a private event loop in a thread, so the
+    # harness can schedule seeding and lag sampling on the app's own loop.
+    def __init__(self, app, port):
+        import uvicorn
+
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.server.serve())
+
+    def start(self):
+        self.thread.start()
+        wait_for_port(self.port)
+        while not self.server.started:
+            time.sleep(0.05)
+
+    def call(self, coro, timeout=300):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(30)
+
+
+def load_server(args, openai_base_url):
+    os.environ["OPENAI_BASE_URL"] = openai_base_url
+    os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+    os.environ["METRICS_TOKEN"] = ""
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["MONGO_URL"] = args.mongo if args.mongo != "memory" else "mongodb://127.0.0.1:27017"
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    if args.mongo == "memory":
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--mongo memory needs mongomock-motor (pip install -r requirements-dev.txt)")
+        server.client = AsyncMongoMockClient(tz_aware=True)
+        server.db = server.client[args.db_name]
+    return server
+
+
+# ============== SEED DATA ==============
+
+async def seed(server, users, history, tier, rng):
+    now = datetime.now(timezone.utc)
+    tokens = []
+    for i in range(users):
+        user_id = f"user_bench{i:06d}"
+        token = f"bench_{uuid.uuid4().hex}"
+        tokens.append(token)
+        await server.db.users.insert_one({
+            "user_id": user_id, "email": f"bench{i}@example.com", "name": f"Bench {i}", "tier": tier, "created_at": now
+        })
+        await server.db.user_sessions.insert_one({
+            "user_id": user_id, "session_token": token, "expires_at": now + timedelta(days=1), "created_at": now
+        })
+        blueprint = server.new_blueprint_doc(user_id)
+        blueprint["company_name"] = f"Bench Co {i}"
+        for layer in blueprint["layers"][:3]:
+            layer["status"] = "completed"
+            layer["progress_percent"] = 100
+            layer["content"] = {"summary": " ".join(rng.choice(LAYER_IDS) for _ in range(120))}
+        await server.db.blueprints.insert_one(blueprint)
+        if history:
+            await server.db.chat_messages.insert_many([
+                {
+                    "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+                    "user_id": user_id,
+                    "role": "user" if n % 2 == 0 else "assistant",
+                    "content": " ".join(rng.choice(LAYER_IDS) for _ in range(40)),
+                    "created_at": now - timedelta(minutes=history - n),
+                }
+                for n in range(history)
+            ])
+    return tokens
+
+
+# ============== LOAD ==============
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+        self.recording = False
+
+    def add(self, op, elapsed, status):
+        if not self.recording:
+            return
+        ok = status < 400
+        if ok:
+            self.latencies.setdefault(op, []).append(elapsed)
+        else:
+            self.errors[op] = self.errors.get(op, 0) + 1
+        self.statuses.setdefault(op, {}).setdefault(str(status), 0)
+        self.statuses[op][str(status)] += 1
+
+
+async def run_op(http, op, token, state, rng, args):
+    headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip, br"}
+    if op == "auth_me":
+        return await http.get("/api/auth/me", headers=headers)
+    if op == "get_blueprint":
+        # Clients revalidate what they already hold
+        if state.get("etag") and rng.random() < args.revalidate_ratio:
+            headers["If-None-Match"] = state["etag"]
+        response = await http.get("/api/blueprint", headers=headers)
+        if response.status_code == 200:
+            state["etag"] = response.headers.get("etag")
+        return response
+    if op == "update_layer":
+        return await http.put("/api/blueprint/layer", headers=headers, json={
+            "layer_id": rng.choice(LAYER_IDS),
+            "content": {"notes": " ".join(rng.choice(LAYER_IDS) for _ in range(60))},
+            "status": "in_progress",
+        })
+    if op == "mentor_chat":
+        return await http.post("/api/chat/mentor", headers=headers, json={
+            "message": f"How should we approach {rng.choice(LAYER_IDS)} next quarter?"
+        })
+    if op == "generate_layer":
+        # A share of prompts repeat so the generation cache sees realistic hits
+        prompt = f"prompt-{rng.randrange(args.prompt_variety)}"
+        return await http.post("/api/generate/layer-content", headers=headers, json={
+            "layer_id": rng.choice(LAYER_IDS), "prompt": prompt, "company_name": "Bench Co", "reuse_cached": True
+        })
+    if op == "export_pdf":
+        return await http.get("/api/export/pdf", headers=headers)
+    raise ValueError(op)
+
+
+async def worker(http, tokens, mix, recorder, deadline, rng, args):
+    ops, weights = zip(*mix.items())
+    token = rng.choice(tokens)
+    state = {}
+    while time.monotonic() < deadline:
+        op = rng.choices(ops, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = await run_op(http, op, token, state, rng, args)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 599
+        recorder.add(op, time.perf_counter() - started, status)
+        if args.think_time:
+            await asyncio.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+async def sample_loop_lag(samples, stop, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - scheduled))
+
+
+async def drive(base_url, tokens, mix, args):
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.request_timeout) as http:
+        warmup_end = time.monotonic() + args.warmup
+        deadline = warmup_end + args.duration
+        workers = [
+            asyncio.create_task(worker(http, tokens, mix, recorder, deadline, random.Random(rng.random()), args))
+            for _ in range(args.concurrency)
+        ]
+        await asyncio.sleep(max(0.0, warmup_end - time.monotonic()))
+        recorder.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*workers)
+        elapsed = time.monotonic() - started
+    return recorder, elapsed
+
+
+# ============== REPORTING ==============
+
+def build_report(args, mix, recorder, elapsed, lag_samples):
+    operations = {
+        op: {**summarize(recorder.latencies.get(op, []), recorder.errors.get(op, 0), elapsed), "statuses": recorder.statuses.get(op, {})}
+        for op in mix
+    }
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    lag = sorted(lag_samples)
+    return {
+        "meta": {
+            "label": args.label,
+            "commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "mongo": "memory" if args.mongo == "memory" else "mongod",
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "users": args.users,
+            "tier": args.tier,
+            "llm_latency": args.llm_latency,
+            "seed": args.seed,
+        },
+        "total": summarize(all_latencies, sum(recorder.errors.values()), elapsed),
+        "operations": operations,
+        "event_loop_lag": {
+            "samples": len(lag),
+            "p50_ms": round(percentile(lag, 50) * 1000, 2),
+            "p99_ms": round(percentile(lag, 99) * 1000, 2),
+            "max_ms": round(lag[-1] * 1000, 2) if lag else 0.0,
+        },
+    }
+
+
+def print_report(report):
+    print(f"{'operation':<16}{'count':>8}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in list(report["operations"].items()) + [("TOTAL", report["total"])]:
+        print(f"{name:<16}{row['count']:>8}{row['errors']:>8}{row['rps']:>9.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    lag = report["event_loop_lag"]
+    print(f"event loop lag: p50 {lag['p50_ms']:.1f} ms, p99 {lag['p99_ms']:.1f} ms, max {lag['max_ms']:.1f} ms")
+
+
+def save_report(report, label):
+    RESULTS_DIR.mkdir(exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = RESULTS_DIR / f"{stamp}{'-' + label if label else ''}.json"
+    path.write_text(json.dumps(report, indent=2))
+    return path
+
+
+def compare(baseline, current, threshold):
+    # Returns the routes whose p95 regressed beyond the threshold
+    regressions = []
+    print(f"{'operation':<16}{'rps':>18}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}")
+    rows = [(op, baseline["operations"].get(op), row) for op, row in current["operations"].items()]
+    rows.append(("TOTAL", baseline["total"], current["total"]))
+    for op, before, after in rows:
+        if not before or not before["count"] or not after["count"]:
+            continue
+        cells = []
+        for key in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+            change = (after[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            cells.append(f"{before[key]:.1f}->{after[key]:.1f} {change:+.0f}%")
+        print(f"{op:<16}" + "".join(f"{cell:>20}" for cell in cells))
+        if before["p95_ms"] and (after["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 > threshold:
+            regressions.append(op)
+    before_lag, after_lag = baseline["event_loop_lag"], current["event_loop_lag"]
+    print(f"event loop lag p99: {before_lag['p99_ms']:.1f} -> {after_lag['p99_ms']:.1f} ms")
+    if regressions:
+        print(f"p95 regressed more than {threshold:.0f}% on: {', '.join(regressions)}")
+    return regressions
+
+
+def run(args):
+    mix = MIXES[args.mix]
+    fake_openai, openai_base_url = start_fake_openai(args)
+    app_server = None
+    try:
+        server = load_server(args, openai_base_url)
+        app_server = AppServer(server.app, free_port())
+        app_server.start()
+        tokens = app_server.call(seed(server, args.users, args.history, args.tier, random.Random(args.seed)))
+
+        lag_samples = []
+        stop = asyncio.Event()
+        lag_task = asyncio.run_coroutine_threadsafe(sample_loop_lag(lag_samples, stop), app_server.loop)
+        recorder, elapsed = asyncio.run(drive(f"http://127.0.0.1:{app_server.port}", tokens, mix, args))
+        app_server.loop.call_soon_threadsafe(stop.set)
+        lag_task.result(5)
+
+        if args.mongo != "memory":
+            app_server.call(server.client.drop_database(args.db_name))
+        return build_report(args, mix, recorder, elapsed, lag_samples)
+    finally:
+        if app_server is not None:
+            app_server.stop()
+        fake_openai.terminate()
+        fake_openai.wait(10)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", default="memory", help="'memory' for mongomock-motor, or a mongodb:// URL")
+    parser.add_argument("--db-name", default=f"loadtest_{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="default")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--history", type=int, default=40, help="chat messages seeded per user")
+    parser.add_argument("--tier", default="enterprise", help="plan of seeded users; lower tiers hit rate limits sooner")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between a worker's requests")
+    parser.add_argument("--revalidate-ratio", type=float, default=0.5)
+    parser.add_argument("--prompt-variety", type=int, default=50)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--baseline", help="earlier result file to compare this run against")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="compare two saved results without running")
+    parser.add_argument("--threshold", type=float, default=10.0, help="p95 regression tolerance in percent")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    if args.diff:
+        old, new = (json.loads(Path(path).read_text()) for path in args.diff)
+        regressions = compare(old, new, args.threshold)
+        sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+    report = run(args)
+    print_report(report)
+    if not args.no_save:
+        print(f"saved {save_report(report, args.label)}")
+    if args.baseline:
+        regressions = compare(json.loads(Path(args.baseline).read_text()), report, args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Cold-start profile for server.py: wall time to import the app plus a
+# breakdown from `python -X importtime`, grouped by top-level package. Meant to
+# run in CI so an eager heavy import shows up as a failed check.
+#
+#   cd backend && python -m benchmarks.startup_profile
+#   cd backend && python -m benchmarks.startup_profile --max-ms 800 --runs 5 --json startup.json
+#
+# Exits non-zero when the median import time exceeds --max-ms or a module
+# listed in --lazy was imported at startup.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# Loaded on first use by the AI and PDF paths; importing them at startup is a regression
+LAZY_MODULES = ("openai", "reportlab", "httpx", "numpy")
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import server
+elapsed = time.perf_counter() - started
+print(json.dumps({"ms": elapsed * 1000, "modules": sorted(sys.modules)}))
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    # Importing server only needs these to be set; no connection is made
+    env.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+    env.setdefault("DB_NAME", "startup_profile")
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def run_probe(importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE]
+    result = subprocess.run(command, cwd=BACKEND_DIR, env=child_env(), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"Importing server failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | imported package".
+    # Self time is summed per top-level package; the package module's own row
+    # gives its cumulative cost including everything it pulled in.
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        module = name.strip()
+        entry = packages.setdefault(module.split(".")[0], {"self_ms": 0.0, "cumulative_ms": 0.0})
+        entry["self_ms"] += int(self_us) / 1000
+        if "." not in module:
+            entry["cumulative_ms"] = max(entry["cumulative_ms"], int(cumulative_us) / 1000)
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3, help="timed imports; the median is reported")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, help="fail when the median import time exceeds this")
+    parser.add_argument("--lazy", default=",".join(LAZY_MODULES), help="comma-separated modules that must not load at startup")
+    parser.add_argument("--json", dest="json_path")
+    args = parser.parse_args()
+
+    # Each run is a fresh interpreter, so every import is a cold one
+    timings = []
+    modules = []
+    for _ in range(max(1, args.runs)):
+        probe, _ = run_probe()
+        timings.append(probe["ms"])
+        modules = probe["modules"]
+    median_ms = statistics.median(timings)
+
+    _, stderr = run_probe(importtime=True)
+    packages = parse_importtime(stderr)
+    ranked = sorted(packages.items(), key=lambda item: item[1]["self_ms"], reverse=True)
+
+    lazy = [name for name in args.lazy.split(",") if name]
+    eager = [name for name in lazy if name in modules]
+
+    print(f"import server: median {median_ms:.0f} ms over {len(timings)} runs ({', '.join(f'{t:.0f}' for t in timings)})")
+    print(f"modules loaded: {len(modules)}")
+    print(f"{'package':<28}{'self ms':>10}{'cumulative ms':>16}")
+    for name, entry in ranked[:args.top]:
+        print(f"{name:<28}{entry['self_ms']:>10.1f}{entry['cumulative_ms']:>16.1f}")
+
+    failures = []
+    if eager:
+        failures.append(f"imported at startup but should be lazy: {', '.join(eager)}")
+    if args.max_ms is not None and median_ms > args.max_ms:
+        failures.append(f"median import time {median_ms:.0f} ms exceeds {args.max_ms:.0f} ms")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "median_ms": round(median_ms, 1),
+                "runs_ms": [round(t, 1) for t in timings],
+                "modules_loaded": len(modules),
+                "eager_lazy_modules": eager,
+                "packages": {name: {k: round(v, 2) for k, v in entry.items()} for name, entry in ranked},
+            }, f, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
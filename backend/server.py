@@ -1,45 +1,497 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Response, Request, Depends
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from bson import ObjectId
 import os
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Dict, Any
 import uuid
+import time
+import json
+import re
+import hashlib
+import csv
+import codecs
+import base64
+import random
+import math
+import bisect
+import threading
+from contextlib import aclosing, asynccontextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
-import httpx
-from io import BytesIO
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-import openai
+from io import BytesIO, StringIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import importlib
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ============== METRICS ==============
+
+# Prometheus text exposition without a client library. Each observation is a
+# dict lookup and a few additions under a lock (Mongo events arrive on driver
+# threads), which is cheap enough to leave on under load.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metrics_registry: List[Any] = []
+
+def escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labelnames, values, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, format_labels(self.labelnames, key), value) for key, value in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class CallbackGauge:
+    # Sampled at scrape time from a function returning [(labels_dict, value), ...]
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames, collect):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        metrics_registry.append(self)
+
+    def samples(self):
+        return [
+            (self.name, format_labels(self.labelnames, [labels.get(n, "") for n in self.labelnames]), value)
+            for labels, value in self.collect()
+        ]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One count per bucket, one for +Inf, then the running sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        out = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((f"{self.name}_bucket", format_labels(self.labelnames, key, f'le="{le}"'), cumulative))
+            out.append((f"{self.name}_sum", format_labels(self.labelnames, key), series[-1]))
+            out.append((f"{self.name}_count", format_labels(self.labelnames, key), cumulative))
+        return out
+
+def render_metrics() -> str:
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route and status", ("method", "route", "status"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served", ("method",))
+mongo_command_duration = Histogram("mongo_command_duration_seconds", "MongoDB command latency by collection and operation", ("collection", "command"))
+mongo_command_errors = Counter("mongo_command_errors_total", "Failed MongoDB commands by collection and operation", ("collection", "command"))
+llm_request_duration = Histogram("llm_request_duration_seconds", "LLM call latency by endpoint and outcome", ("endpoint", "outcome"))
+llm_tokens = Counter("llm_tokens_total", "LLM tokens used by endpoint and kind", ("endpoint", "kind"))
+llm_errors = Counter("llm_errors_total", "LLM call errors by endpoint and error class", ("endpoint", "error"))
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds", "Delay of a periodic event loop tick beyond its schedule",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    # Driver events fire on pymongo's threads; started/succeeded are paired by request id
+    SKIP = {"hello", "ismaster", "isMaster", "ping", "saslStart", "saslContinue", "endSessions", "buildInfo"}
+
+    def __init__(self):
+        self._collections: Dict[tuple, str] = {}
+
+    def started(self, event):
+        if event.command_name in self.SKIP:
+            return
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        else:
+            target = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = target if isinstance(target, str) else "-"
+
+    def _pop(self, event) -> Optional[str]:
+        return self._collections.pop((event.connection_id, event.request_id), None)
+
+    def succeeded(self, event):
+        collection = self._pop(event)
+        if collection is not None:
+            mongo_command_duration.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+
+    def failed(self, event):
+        collection = self._pop(event)
+        if collection is not None:
+            mongo_command_duration.observe(event.duration_micros / 1e6, collection=collection, command=event.command_name)
+            mongo_command_errors.inc(collection=collection, command=event.command_name)
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec(method=method)
+            # Route templates keep label cardinality bounded; unmatched paths share one label
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                method=method,
+                route=getattr(route, "path", "unmatched"),
+                status=str(status["code"])
+            )
+
+async def monitor_event_loop_lag(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - scheduled))
+
+mongo_command_metrics = MongoCommandMetrics()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Dates come back timezone-aware so they serialize with their UTC offset
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[mongo_command_metrics])
 db = client[os.environ['DB_NAME']]
 
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse if orjson else JSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # OpenAI API Key
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
-openai.api_key = OPENAI_API_KEY
+# Point at any OpenAI-compatible server, e.g. a local fake for load tests
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+
+# LLM client: shared connection pool, concurrency cap and retry policy
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '16'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '64'))
+LLM_QUEUE_WAIT_SECONDS = float(os.environ.get('LLM_QUEUE_WAIT_SECONDS', '30'))
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', '60'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+LLM_RETRY_BASE_SECONDS = float(os.environ.get('LLM_RETRY_BASE_SECONDS', '0.5'))
+LLM_RETRY_MAX_SECONDS = float(os.environ.get('LLM_RETRY_MAX_SECONDS', '20'))
+LLM_POOL_CONNECTIONS = int(os.environ.get('LLM_POOL_CONNECTIONS', '32'))
+
+# Auth cache: resolved users are cached per session token for a short TTL so that
+# logouts on other workers are picked up quickly even without a shared cache.
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '60'))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', '10000'))
+
+# Generation cache: an in-memory LRU in front of the generation_cache collection
+GENERATION_CACHE_TTL_SECONDS = float(os.environ.get('GENERATION_CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+GENERATION_CACHE_MAX_ENTRIES = int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', '2000'))
+GENERATION_CACHE_MAX_DOCUMENTS = int(os.environ.get('GENERATION_CACHE_MAX_DOCUMENTS', '100000'))
+
+# Semantic cache: serves layer generations for near-duplicate prompts when the
+# request sets reuse_similar. Vectors are hashed character n-grams (numpy).
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.9'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', '20000'))
+SEMANTIC_CACHE_DIMENSIONS = int(os.environ.get('SEMANTIC_CACHE_DIMENSIONS', '1024'))
+SEMANTIC_CACHE_LSH_TABLES = int(os.environ.get('SEMANTIC_CACHE_LSH_TABLES', '8'))
+SEMANTIC_CACHE_LSH_BITS = int(os.environ.get('SEMANTIC_CACHE_LSH_BITS', '8'))
+
+# Layer revisions are stored as diffs against the previous revision, with a full
+# snapshot every N revisions so restoring replays at most N-1 diffs
+LAYER_REVISION_SNAPSHOT_EVERY = int(os.environ.get('LAYER_REVISION_SNAPSHOT_EVERY', '20'))
+LAYER_REVISION_PAGE_SIZE = int(os.environ.get('LAYER_REVISION_PAGE_SIZE', '50'))
+
+# Seconds one-off background work (stats, usage charges) gets to finish at shutdown
+BACKGROUND_SHUTDOWN_SECONDS = float(os.environ.get('BACKGROUND_SHUTDOWN_SECONDS', '5'))
+
+# PDF export: rendering runs in a worker pool; rendered files are cached per blueprint version
+PDF_RENDER_EXECUTOR = os.environ.get('PDF_RENDER_EXECUTOR', 'thread')  # thread or process
+PDF_RENDER_WORKERS = int(os.environ.get('PDF_RENDER_WORKERS', '2'))
+PDF_RENDER_MAX_PENDING = int(os.environ.get('PDF_RENDER_MAX_PENDING', '8'))
+PDF_RENDER_TIMEOUT_SECONDS = float(os.environ.get('PDF_RENDER_TIMEOUT_SECONDS', '60'))
+PDF_CACHE_MAX_ENTRIES = int(os.environ.get('PDF_CACHE_MAX_ENTRIES', '256'))
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+PDF_CACHE_TTL_SECONDS = float(os.environ.get('PDF_CACHE_TTL_SECONDS', '3600'))
+
+# Mentor chat context: a rolling summary plus a recent-message window per user
+MENTOR_CONTEXT_TOKEN_BUDGET = int(os.environ.get('MENTOR_CONTEXT_TOKEN_BUDGET', '1500'))
+MENTOR_RECENT_MAX_MESSAGES = int(os.environ.get('MENTOR_RECENT_MAX_MESSAGES', '20'))
+MENTOR_SUMMARY_MAX_TOKENS = int(os.environ.get('MENTOR_SUMMARY_MAX_TOKENS', '400'))
+
+# Response compression: bodies smaller than this are sent as-is
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+
+# Comma-separated emails allowed to use admin endpoints
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+
+# Bearer token required to scrape /metrics; empty leaves it open to the network
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Waitlist bulk import batch size
+WAITLIST_IMPORT_BATCH_SIZE = int(os.environ.get('WAITLIST_IMPORT_BATCH_SIZE', '1000'))
+
+# Chat history page sizes
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', '50'))
+CHAT_HISTORY_MAX_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_MAX_PAGE_SIZE', '200'))
+
+# Chat messages are written behind in batches; a crash can lose at most the
+# last flush interval of messages
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'true').lower() == 'true'
+CHAT_WRITE_FLUSH_SECONDS = float(os.environ.get('CHAT_WRITE_FLUSH_SECONDS', '0.25'))
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', '500'))
+CHAT_WRITE_MAX_PENDING = int(os.environ.get('CHAT_WRITE_MAX_PENDING', '5000'))
+
+# Longest a coalesced caller waits on a shared in-flight LLM call
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.environ.get('SINGLE_FLIGHT_WAIT_SECONDS', '120'))
+
+# Most layers one /generate/layers request generates at the same time
+GENERATE_LAYERS_CONCURRENCY = int(os.environ.get('GENERATE_LAYERS_CONCURRENCY', '3'))
+
+# Rate limits per tier and route group: a token bucket refilling at per_minute
+# that holds up to burst requests. RATE_LIMITS (JSON) overrides single entries,
+# e.g. {"free": {"generate": {"per_minute": 10}}}
+RATE_LIMIT_DEFAULTS = {
+    "free": {"generate": {"per_minute": 6, "burst": 3}, "chat": {"per_minute": 10, "burst": 5}, "export": {"per_minute": 6, "burst": 3}},
+    "pro": {"generate": {"per_minute": 30, "burst": 10}, "chat": {"per_minute": 60, "burst": 20}, "export": {"per_minute": 30, "burst": 10}},
+    "enterprise": {"generate": {"per_minute": 120, "burst": 30}, "chat": {"per_minute": 240, "burst": 60}, "export": {"per_minute": 120, "burst": 30}},
+}
+RATE_LIMIT_OVERRIDES = json.loads(os.environ.get('RATE_LIMITS') or '{}')
+RATE_LIMITS = {
+    tier: {group: {**limit, **RATE_LIMIT_OVERRIDES.get(tier, {}).get(group, {})} for group, limit in groups.items()}
+    for tier, groups in RATE_LIMIT_DEFAULTS.items()
+}
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# Persist buckets to Mongo so restarts and other workers see recent spend
+RATE_LIMIT_PERSIST = os.environ.get('RATE_LIMIT_PERSIST', 'false').lower() == 'true'
+RATE_LIMIT_FLUSH_SECONDS = float(os.environ.get('RATE_LIMIT_FLUSH_SECONDS', '5'))
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', '100000'))
+
+# LLM tokens a user may spend per UTC day by tier; 0 means unlimited
+DAILY_TOKEN_QUOTAS = {
+    "free": 50000, "pro": 2000000, "enterprise": 0,
+    **json.loads(os.environ.get('DAILY_TOKEN_QUOTAS') or '{}')
+}
+
+# Import the AI and PDF dependencies in the background once the app is up
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'true').lower() == 'true'
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# ============== RESPONSES ==============
+
+def json_response(content: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    # Large payloads skip FastAPI's jsonable_encoder pass; orjson serializes
+    # datetimes and nested dicts natively
+    if orjson is not None:
+        return ORJSONResponse(content, status_code=status_code, headers=headers)
+    return JSONResponse(jsonable_encoder(content), status_code=status_code, headers=headers)
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        if self.encoding == "br":
+            out = self._compressor.process(data)
+            return out + self._compressor.flush() if flush else out
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else out
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class CompressionMiddleware:
+    # Negotiates brotli or gzip from Accept-Encoding. Event streams are never
+    # touched (compression would buffer them) and neither are PDFs or bodies that
+    # are already encoded. Other streamed bodies are compressed chunk by chunk.
+    SKIP_TYPES = ("text/event-stream", "application/pdf", "application/zip", "application/gzip", "image/")
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = dict(scope["headers"])
+        encoding = negotiate_encoding(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "mode": None, "compressor": None}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if state["mode"] is None:
+                start = state["start"]
+                headers = {k.lower(): v for k, v in start["headers"]}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if (b"content-encoding" in headers or start["status"] in (204, 304)
+                        or content_type.startswith(self.SKIP_TYPES)
+                        or (not more_body and len(body) < self.minimum_size)):
+                    state["mode"] = "passthrough"
+                    await send(start)
+                else:
+                    state["mode"] = "compress"
+                    state["compressor"] = StreamCompressor(encoding)
+                    rewritten = [(k, v) for k, v in start["headers"] if k.lower() not in (b"content-length", b"etag")]
+                    rewritten.append((b"content-encoding", encoding.encode()))
+                    rewritten.append((b"vary", b"Accept-Encoding"))
+                    etag = headers.get(b"etag")
+                    if etag:
+                        # The compressed bytes differ, so the tag can only be weak
+                        rewritten.append((b"etag", etag if etag.startswith(b"W/") else b"W/" + etag))
+                    if not more_body:
+                        body = state["compressor"].compress(body) + state["compressor"].finish()
+                        rewritten.append((b"content-length", str(len(body)).encode()))
+                        await send({**start, "headers": rewritten})
+                        await send({"type": "http.response.body", "body": body})
+                        return
+                    await send({**start, "headers": rewritten})
+            
+            if state["mode"] == "passthrough":
+                await send(message)
+                return
+            compressor = state["compressor"]
+            if more_body:
+                chunk = compressor.compress(body, flush=True)
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": compressor.compress(body) + compressor.finish()})
+
+        await self.app(scope, receive, send_compressed)
+
 # ============== MODELS ==============
 
 class User(BaseModel):
@@ -48,6 +500,8 @@ class User(BaseModel):
     email: str
     name: str
     picture: Optional[str] = None
+    # Billing plan (free, pro or enterprise); drives rate limits and token quotas
+    tier: str = "free"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class UserSession(BaseModel):
@@ -100,11 +554,29 @@ class LayerContentRequest(BaseModel):
     layer_id: str
     prompt: str
     company_name: Optional[str] = ""
+    # Sampling is not deterministic, so serving an earlier answer is opt-in
+    reuse_cached: bool = False
+    # Also accept an answer cached for a near-identical prompt
+    reuse_similar: bool = False
+    bypass_cache: bool = False
+
+class LayerBatchRequest(BaseModel):
+    # Defaults to every layer; prompts overrides the shared prompt per layer
+    layer_ids: Optional[List[str]] = None
+    prompt: str = ""
+    prompts: Dict[str, str] = Field(default_factory=dict)
+    company_name: Optional[str] = ""
+    concurrency: Optional[int] = None
+    reuse_cached: bool = False
+    reuse_similar: bool = False
+    bypass_cache: bool = False
+    persist: bool = False
 
 class LayerUpdateRequest(BaseModel):
     layer_id: str
     content: Dict[str, Any]
     status: Optional[str] = None
+    return_layers: bool = False
 
 class ChatRequest(BaseModel):
     message: str
@@ -113,18 +585,562 @@ class ChatRequest(BaseModel):
 class BlueprintCreateRequest(BaseModel):
     company_name: str
 
+# ============== DATABASE INDEXES ==============
+
+# Declared indexes per collection. Unique indexes back the places where the code
+# assumes a single document (one user per email, one blueprint per user, ...).
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "user_sessions": [
+        IndexModel([("session_token", ASCENDING)], name="session_token_unique", unique=True),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        # Mongo reaps a session as soon as its expires_at date has passed
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "blueprints": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "chat_messages": [
+        # Backs keyset pagination over (created_at, message_id)
+        IndexModel(
+            [("user_id", ASCENDING), ("created_at", ASCENDING), ("message_id", ASCENDING)],
+            name="user_id_created_at_message_id"
+        ),
+    ],
+    "waitlist": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "chat_state": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "generation_cache": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "usage_daily": [
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], name="user_id_day_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "layer_revisions": [
+        IndexModel([("user_id", ASCENDING), ("layer_id", ASCENDING), ("revision", ASCENDING)], name="user_id_layer_id_revision_unique", unique=True),
+    ],
+    "user_activity": [
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], name="user_id_day_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "rate_limit_buckets": [
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Superseded indexes, dropped once their replacements are built
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+    "chat_messages": ["user_id_created_at"],
+}
+
+# Fields that older documents stored as ISO strings instead of BSON dates
+DATE_MIGRATIONS = [
+    ("user_sessions", "expires_at"),
+    ("chat_messages", "created_at"),
+]
+
+# "<collection>.<index name>" -> {"state": pending|building|ready|failed, ...}
+index_status: Dict[str, Dict[str, Any]] = {
+    f"{collection}.{model.document['name']}": {"state": "pending"}
+    for collection, models in INDEXES.items()
+    for model in models
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parse_stored_date(value: Any) -> Optional[datetime]:
+    # Dates may still be ISO strings in documents the migration has not reached
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+async def migrate_iso_dates(collection: str, field: str, batch_size: int = 1000) -> int:
+    # Older documents stored dates as ISO strings, which TTL indexes ignore and
+    # which sort apart from real dates. Convert them in place, in batches.
+    # Strings that do not parse fall back to the ObjectId's creation time, with
+    # the original kept alongside as <field>_unparsed.
+    converted = 0
+    unparsed = 0
+    batch = []
+    cursor = db[collection].find({field: {"$type": "string"}}, {field: 1})
+    async for doc in cursor:
+        value = parse_stored_date(doc[field])
+        update = {field: value}
+        if value is None:
+            update[field] = doc["_id"].generation_time if isinstance(doc["_id"], ObjectId) else EPOCH
+            update[f"{field}_unparsed"] = doc[field]
+            unparsed += 1
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+        if len(batch) >= batch_size:
+            await db[collection].bulk_write(batch, ordered=False)
+            converted += len(batch)
+            batch = []
+    if batch:
+        await db[collection].bulk_write(batch, ordered=False)
+        converted += len(batch)
+    if unparsed:
+        logger.warning(f"{unparsed} {collection}.{field} values were not valid dates; used the document creation time")
+    return converted
+
+async def ensure_indexes():
+    for collection, field in DATE_MIGRATIONS:
+        try:
+            converted = await migrate_iso_dates(collection, field)
+            if converted:
+                logger.info(f"Converted {converted} {collection}.{field} values to dates")
+        except PyMongoError as e:
+            logger.error(f"Date migration failed for {collection}.{field}: {e}")
+    
+    for collection, models in INDEXES.items():
+        for model in models:
+            key = f"{collection}.{model.document['name']}"
+            index_status[key] = {"state": "building", "started_at": datetime.now(timezone.utc).isoformat()}
+            started = time.monotonic()
+            try:
+                await db[collection].create_indexes([model])
+            except PyMongoError as e:
+                # Typically existing duplicates blocking a unique index
+                logger.error(f"Index build failed for {key}: {e}")
+                index_status[key].update({"state": "failed", "error": str(e)})
+                continue
+            index_status[key].update({"state": "ready", "build_seconds": round(time.monotonic() - started, 3)})
+    
+    for collection, names in OBSOLETE_INDEXES.items():
+        for name in names:
+            try:
+                await db[collection].drop_index(name)
+                logger.info(f"Dropped obsolete index {collection}.{name}")
+            except PyMongoError:
+                pass
+    
+    failed = [key for key, status in index_status.items() if status["state"] == "failed"]
+    if failed:
+        logger.warning(f"Index bootstrap finished with failures: {', '.join(failed)}")
+    else:
+        logger.info(f"Index bootstrap finished: {len(index_status)} indexes ready")
+
+async def index_usage() -> Dict[str, int]:
+    usage = {}
+    for collection in INDEXES:
+        try:
+            async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                usage[f"{collection}.{stat['name']}"] = stat["accesses"]["ops"]
+        except PyMongoError:
+            continue
+    return usage
+
+# ============== CACHING ==============
+
+cache_registry: Dict[str, Any] = {}
+
+class TTLCache:
+    # Bounded LRU cache whose entries also expire after a TTL. When max_bytes is
+    # set, entries are also weighed with sizeof and evicted to stay under it.
+    # Not thread-safe; it is only touched from the event loop.
+    def __init__(self, name: str, maxsize: int, ttl: float, max_bytes: Optional[int] = None, sizeof=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        cache_registry[name] = self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _discard(self, key: Any) -> Any:
+        value, _, size = self._data.pop(key)
+        self._bytes -= size
+        return value
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires, _ = item
+        if expires <= time.monotonic():
+            self._discard(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        size = self.sizeof(value)
+        if ttl <= 0 or self.maxsize <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        if key in self._data:
+            self._discard(key)
+        self._data[key] = (value, time.monotonic() + ttl, size)
+        self._bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+            self._discard(next(iter(self._data)))
+            self.evictions += 1
+
+    def pop(self, key: Any) -> Any:
+        return self._discard(key) if key in self._data else None
+
+    def pop_where(self, predicate) -> int:
+        keys = [k for k, (v, _, _) in self._data.items() if predicate(v)]
+        for k in keys:
+            self._discard(k)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+        if self.max_bytes is not None:
+            stats.update({"bytes": self._bytes, "max_bytes": self.max_bytes})
+        return stats
+
+auth_cache = TTLCache("auth", AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL_SECONDS)
+
+# Bumped on every session invalidation. A lookup that was already reading when
+# a session was deleted sees a newer generation and skips caching its result,
+# so the deleted session cannot be put back in the cache.
+auth_generation = 0
+
+def invalidate_cached_sessions(session_token: Optional[str] = None, user_id: Optional[str] = None) -> None:
+    global auth_generation
+    auth_generation += 1
+    if session_token:
+        auth_cache.pop(session_token)
+    if user_id:
+        auth_cache.pop_where(lambda cached: cached.user_id == user_id)
+
+class GenerationCache:
+    # Two tiers: a per-process LRU in front of a shared Mongo collection. Mongo
+    # entries expire through a TTL index and are capped at max_documents.
+    def __init__(self, collection: str, maxsize: int, ttl: float, max_documents: int):
+        self.collection = collection
+        self.ttl = ttl
+        self.max_documents = max_documents
+        self.memory = TTLCache(f"{collection}_memory", maxsize, ttl)
+        self.mongo_hits = 0
+        self.misses = 0
+        self.writes = 0
+        cache_registry[collection] = self
+
+    @staticmethod
+    def key_for(params: Dict[str, Any]) -> str:
+        # Whitespace differences in the rendered prompt should not defeat the cache
+        normalized = {
+            "model": params["model"],
+            "temperature": params["temperature"],
+            "max_tokens": params["max_tokens"],
+            "messages": [
+                {"role": m["role"], "content": " ".join(m["content"].split())}
+                for m in params["messages"]
+            ],
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        now = datetime.now(timezone.utc)
+        doc = await db[self.collection].find_one({"_id": key, "expires_at": {"$gt": now}})
+        if not doc:
+            self.misses += 1
+            return None
+        self.mongo_hits += 1
+        expires_at = doc["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        self.memory.set(key, doc["result"], ttl=(expires_at - now).total_seconds())
+        return doc["result"]
+
+    async def set(self, key: str, result: Dict[str, Any], **metadata) -> None:
+        self.memory.set(key, result)
+        now = datetime.now(timezone.utc)
+        await db[self.collection].update_one(
+            {"_id": key},
+            {"$set": {**metadata, "result": result, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+            upsert=True
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            await self.prune()
+
+    async def prune(self) -> int:
+        excess = await db[self.collection].estimated_document_count() - self.max_documents
+        if excess <= 0:
+            return 0
+        oldest = await db[self.collection].find({}, {"_id": 1}).sort("created_at", 1).limit(excess).to_list(excess)
+        result = await db[self.collection].delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
+        return result.deleted_count
+
+    def stats(self) -> Dict[str, Any]:
+        memory_hits = self.memory.hits
+        lookups = memory_hits + self.mongo_hits + self.misses
+        return {
+            "memory_hits": memory_hits,
+            "mongo_hits": self.mongo_hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": round((memory_hits + self.mongo_hits) / lookups, 4) if lookups else 0.0,
+            "ttl_seconds": self.ttl,
+            "max_documents": self.max_documents,
+        }
+
+class SingleFlight:
+    # Coalesces concurrent calls that share a key into one execution. The call
+    # runs in its own task so one caller going away does not fail the others;
+    # it is cancelled only once every caller has stopped waiting.
+    def __init__(self, name: str, timeout: float):
+        self.timeout = timeout
+        self._calls: Dict[str, Dict[str, Any]] = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        cache_registry[name] = self
+
+    def _finished(self, key: str, call: Dict[str, Any]) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        task = call["task"]
+        if not task.cancelled():
+            # Mark the error as retrieved even if every waiter already left
+            task.exception()
+
+    async def do(self, key: str, fn):
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(fn()), "waiters": 0}
+            call["task"].add_done_callback(lambda _: self._finished(key, call))
+            self._calls[key] = call
+            self.executions += 1
+        else:
+            self.coalesced += 1
+        call["waiters"] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call["task"]), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                call["task"].cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.executions + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "coalesce_rate": round(self.coalesced / calls, 4) if calls else 0.0,
+        }
+
+llm_single_flight = SingleFlight("llm_single_flight", SINGLE_FLIGHT_WAIT_SECONDS)
+
+generation_cache = GenerationCache(
+    "generation_cache", GENERATION_CACHE_MAX_ENTRIES, GENERATION_CACHE_TTL_SECONDS, GENERATION_CACHE_MAX_DOCUMENTS
+)
+
+class SemanticCache:
+    # Offline near-duplicate lookup for layer prompts. A prompt becomes an
+    # L2-normalised vector of hashed character 3-grams, so cosine similarity
+    # tolerates small edits ("SaaS for dentists" vs "a SaaS for dentists.").
+    # Random-hyperplane LSH narrows each lookup to a few candidate entries.
+    # Entries are partitioned by layer and company name, so one company's
+    # content is never served to another. All state is per process.
+    NGRAM = 3
+
+    def __init__(self, name: str, threshold: float, max_entries: int, ttl: float,
+                 dimensions: int, tables: int, bits: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.dimensions = dimensions
+        self.tables = tables
+        self.bits = bits
+        self._planes = None
+        # entry id -> (partition, vector, signatures, result, expires)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # partition -> one {signature: set of entry ids} per LSH table
+        self._buckets: Dict[tuple, List[Dict[int, set]]] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        cache_registry[name] = self
+
+    @staticmethod
+    def partition(layer_id: str, company_name: Optional[str]) -> tuple:
+        return (layer_id, " ".join((company_name or "").casefold().split()))
+
+    def vectorize(self, text: str):
+        import numpy as np
+
+        normalized = " " + " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split()[:400]) + " "
+        grams = [normalized[i:i + self.NGRAM].encode() for i in range(len(normalized) - self.NGRAM + 1)]
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        if grams:
+            hashes = np.array([zlib.crc32(gram) for gram in grams], dtype=np.uint64)
+            # The low bits pick the slot, the next bit the sign, which keeps
+            # collisions from always adding up
+            signs = np.where((hashes >> np.uint64(20)) & np.uint64(1), 1.0, -1.0).astype(np.float32)
+            np.add.at(vector, (hashes % np.uint64(self.dimensions)).astype(np.int64), signs)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def signatures(self, vector) -> List[int]:
+        import numpy as np
+
+        if self._planes is None:
+            rng = np.random.default_rng(0x5eed)
+            self._planes = rng.standard_normal((self.tables, self.bits, self.dimensions)).astype(np.float32)
+        bits = (self._planes @ vector) > 0
+        weights = 1 << np.arange(self.bits, dtype=np.int64)
+        return [int(signature) for signature in (bits * weights).sum(axis=1)]
+
+    def _remove(self, entry_id: int) -> None:
+        partition, _, signatures, _, _ = self._entries.pop(entry_id)
+        tables = self._buckets.get(partition)
+        if not tables:
+            return
+        for table, signature in zip(tables, signatures):
+            ids = table.get(signature)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del table[signature]
+        if not any(tables):
+            del self._buckets[partition]
+
+    def lookup(self, layer_id: str, company_name: Optional[str], prompt: str) -> Optional[Dict[str, Any]]:
+        import numpy as np
+
+        tables = self._buckets.get(self.partition(layer_id, company_name))
+        if not tables or not prompt.strip():
+            self.misses += 1
+            return None
+        vector = self.vectorize(prompt)
+        candidates = set()
+        for table, signature in zip(tables, self.signatures(vector)):
+            candidates |= table.get(signature, set())
+        now = time.monotonic()
+        for entry_id in [i for i in candidates if self._entries[i][4] <= now]:
+            self._remove(entry_id)
+            candidates.discard(entry_id)
+        if not candidates:
+            self.misses += 1
+            return None
+        ids = list(candidates)
+        scores = np.stack([self._entries[i][1] for i in ids]) @ vector
+        best = int(np.argmax(scores))
+        if float(scores[best]) < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(ids[best])
+        return {**self._entries[ids[best]][3], "similarity": round(float(scores[best]), 4)}
+
+    def add(self, layer_id: str, company_name: Optional[str], prompt: str, result: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        if not prompt.strip():
+            return
+        partition = self.partition(layer_id, company_name)
+        vector = self.vectorize(prompt)
+        signatures = self.signatures(vector)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (partition, vector, signatures, result, time.monotonic() + (ttl or self.ttl))
+        tables = self._buckets.setdefault(partition, [{} for _ in range(self.tables)])
+        for table, signature in zip(tables, signatures):
+            table.setdefault(signature, set()).add(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def load(self, collection: str) -> int:
+        # Rebuilds the index from the newest generation cache documents
+        now = datetime.now(timezone.utc)
+        docs = await db[collection].find(
+            {"prompt": {"$exists": True}, "expires_at": {"$gt": now}},
+            {"_id": 0, "layer_id": 1, "company_name": 1, "prompt": 1, "result": 1, "expires_at": 1}
+        ).sort("created_at", -1).limit(self.max_entries).to_list(self.max_entries)
+        for doc in reversed(docs):
+            expires_at = doc["expires_at"]
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            self.add(doc["layer_id"], doc.get("company_name"), doc["prompt"], doc["result"], ttl=(expires_at - now).total_seconds())
+        return len(docs)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.max_entries,
+            "partitions": len(self._buckets),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+semantic_cache = SemanticCache(
+    "semantic_cache", SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, GENERATION_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_DIMENSIONS, SEMANTIC_CACHE_LSH_TABLES, SEMANTIC_CACHE_LSH_BITS
+)
+
 # ============== AUTH HELPERS ==============
 
-async def get_current_user(request: Request) -> Optional[User]:
+def get_session_token(request: Request) -> Optional[str]:
     session_token = request.cookies.get("session_token")
     if not session_token:
         auth_header = request.headers.get("Authorization")
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
-    
+    return session_token
+
+async def get_current_user(request: Request) -> Optional[User]:
+    session_token = get_session_token(request)
     if not session_token:
         return None
     
+    cached_user = auth_cache.get(session_token)
+    if cached_user is not None:
+        return cached_user
+    generation = auth_generation
+    
     session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
     if not session_doc:
         return None
@@ -134,14 +1150,20 @@ async def get_current_user(request: Request) -> Optional[User]:
         expires_at = datetime.fromisoformat(expires_at)
     if expires_at.tzinfo is None:
         expires_at = expires_at.replace(tzinfo=timezone.utc)
-    if expires_at < datetime.now(timezone.utc):
+    now = datetime.now(timezone.utc)
+    if expires_at < now:
         return None
     
     user_doc = await db.users.find_one({"user_id": session_doc["user_id"]}, {"_id": 0})
     if not user_doc:
         return None
     
-    return User(**user_doc)
+    user = User(**user_doc)
+    # Never cache past the session's own expiry, nor a session invalidated mid-lookup
+    if generation == auth_generation:
+        auth_cache.set(session_token, user, ttl=(expires_at - now).total_seconds())
+    spawn_background(mark_active(user.user_id))
+    return user
 
 async def require_auth(request: Request) -> User:
     user = await get_current_user(request)
@@ -149,6 +1171,282 @@ async def require_auth(request: Request) -> User:
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
+async def require_admin(request: Request) -> User:
+    user = await require_auth(request)
+    if user.email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+async def require_diagnostics(request: Request) -> None:
+    # Diagnostic endpoints accept the metrics token (when one is configured) or an admin session
+    if METRICS_TOKEN and request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}":
+        return
+    await require_admin(request)
+
+# ============== RATE LIMITING ==============
+
+# The user on whose behalf LLM calls are made. Set by rate_limit() and inherited
+# by tasks the request spawns, so fair queueing and token quotas see the caller.
+llm_user: ContextVar[Optional[User]] = ContextVar("llm_user", default=None)
+
+# Route groups that spend LLM tokens and so are subject to daily quotas
+LLM_ROUTE_GROUPS = {"generate", "chat"}
+
+def too_many_requests(detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+class TokenBucketLimiter:
+    # Buckets live in an LRU keyed by user and route group. With persistence on,
+    # changed buckets are written behind to Mongo and read back on first use, so
+    # a restart does not hand everyone a fresh burst.
+    def __init__(self, max_buckets: int, persist: bool, flush_interval: float):
+        self.max_buckets = max_buckets
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._dirty = set()
+        self.allowed = 0
+        self.limited = 0
+
+    async def _bucket(self, key: str, burst: float) -> List[float]:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._buckets.move_to_end(key)
+            return bucket
+        # [tokens, last refill as wall-clock time so persisted buckets stay valid]
+        bucket = [float(burst), time.time()]
+        if self.persist:
+            try:
+                doc = await db.rate_limit_buckets.find_one({"key": key}, {"_id": 0, "tokens": 1, "updated": 1})
+            except PyMongoError as e:
+                logger.warning(f"Rate limit bucket load failed: {e}")
+                doc = None
+            if doc:
+                bucket = [doc["tokens"], doc["updated"]]
+            if key in self._buckets:
+                return self._buckets[key]
+        self._buckets[key] = bucket
+        while len(self._buckets) > self.max_buckets:
+            evicted, _ = self._buckets.popitem(last=False)
+            self._dirty.discard(evicted)
+        return bucket
+
+    async def take(self, key: str, per_minute: float, burst: float, cost: float = 1.0) -> float:
+        # Returns 0 when admitted, otherwise seconds until the request would be
+        bucket = await self._bucket(key, burst)
+        rate = per_minute / 60.0
+        now = time.time()
+        bucket[0] = min(float(burst), bucket[0] + max(0.0, now - bucket[1]) * rate)
+        bucket[1] = now
+        if self.persist:
+            self._dirty.add(key)
+        # A cost above the burst is admitted once the bucket is full; the
+        # balance goes negative and later requests wait until it refills
+        needed = min(cost, float(burst))
+        if bucket[0] >= needed:
+            bucket[0] -= cost
+            self.allowed += 1
+            return 0.0
+        self.limited += 1
+        return (needed - bucket[0]) / rate
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        # Every bucket has refilled long before this, so stale documents can go
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+        ops = [
+            UpdateOne(
+                {"key": key},
+                {"$set": {"tokens": self._buckets[key][0], "updated": self._buckets[key][1], "expires_at": expires_at}},
+                upsert=True
+            )
+            for key in keys if key in self._buckets
+        ]
+        if not ops:
+            return
+        try:
+            await db.rate_limit_buckets.bulk_write(ops, ordered=False)
+        except PyMongoError as e:
+            logger.warning(f"Rate limit bucket flush failed: {e}")
+            self._dirty |= keys
+
+    async def run_flusher(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buckets": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "persist": self.persist,
+        }
+
+def utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+def seconds_until_utc_midnight() -> float:
+    now = datetime.now(timezone.utc)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+class TokenQuota:
+    # Daily LLM token spend per user in usage_daily, fed by completion usage.
+    # Reads go through a short-lived cache, so several workers may overshoot a
+    # quota by at most a few calls.
+    def __init__(self, quotas: Dict[str, int]):
+        self.quotas = quotas
+        self.usage = TTLCache("usage_daily", maxsize=10000, ttl=30)
+        self.exceeded = 0
+
+    def limit_for(self, user: User) -> int:
+        return int(self.quotas.get(user.tier, self.quotas.get("free", 0)))
+
+    async def used_today(self, user_id: str) -> int:
+        key = f"{user_id}:{utc_day()}"
+        used = self.usage.get(key)
+        if used is None:
+            doc = await db.usage_daily.find_one({"user_id": user_id, "day": utc_day()}, {"_id": 0, "tokens": 1})
+            used = doc["tokens"] if doc else 0
+            self.usage.set(key, used)
+        return used
+
+    async def check(self, user: User) -> None:
+        limit = self.limit_for(user)
+        if limit <= 0:
+            return
+        try:
+            used = await self.used_today(user.user_id)
+        except PyMongoError as e:
+            # Fail open: a usage read hiccup should not take AI features down
+            logger.warning(f"Token quota check failed: {e}")
+            return
+        if used >= limit:
+            self.exceeded += 1
+            raise too_many_requests("Daily AI usage limit reached", seconds_until_utc_midnight())
+
+    async def charge(self, user_id: str, prompt_tokens: int, completion_tokens: int) -> None:
+        day = utc_day()
+        total = prompt_tokens + completion_tokens
+        key = f"{user_id}:{day}"
+        cached = self.usage.get(key)
+        if cached is not None:
+            self.usage.set(key, cached + total)
+        try:
+            await db.usage_daily.update_one(
+                {"user_id": user_id, "day": day},
+                {
+                    "$inc": {"tokens": total, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "requests": 1},
+                    # Kept for a month of usage reporting
+                    "$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(days=35)}
+                },
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(f"Token usage write failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"quotas": self.quotas, "exceeded": self.exceeded}
+
+request_limiter = TokenBucketLimiter(RATE_LIMIT_MAX_BUCKETS, RATE_LIMIT_PERSIST, RATE_LIMIT_FLUSH_SECONDS)
+token_quota = TokenQuota(DAILY_TOKEN_QUOTAS)
+
+async def rate_limit(user: User, group: str, cost: float = 1.0) -> None:
+    llm_user.set(user)
+    if not RATE_LIMIT_ENABLED:
+        return
+    limit = RATE_LIMITS.get(user.tier, RATE_LIMITS["free"]).get(group)
+    if limit and limit["per_minute"] > 0:
+        retry_after = await request_limiter.take(f"{user.user_id}:{group}", limit["per_minute"], limit["burst"], cost)
+        if retry_after:
+            raise too_many_requests("Too many requests, please slow down", retry_after)
+    if group in LLM_ROUTE_GROUPS:
+        await token_quota.check(user)
+
+# ============== STATS ==============
+
+# Cross-user aggregates live in the stats collection: one "totals" document and
+# one document per UTC day, kept current with $inc from the write paths, so
+# reading them never scans blueprints. Increments are best effort; the admin
+# rebuild endpoint recomputes the totals from scratch.
+
+ACTIVITY_RETENTION_DAYS = 90
+
+active_users_seen = TTLCache("active_users", maxsize=100000, ttl=3600)
+
+def stats_day_id(day: Optional[str] = None) -> str:
+    return f"day:{day or utc_day()}"
+
+async def bump_stats(totals: Dict[str, int], daily: Optional[Dict[str, int]] = None) -> None:
+    now = datetime.now(timezone.utc)
+    ops = []
+    totals = {key: value for key, value in totals.items() if value}
+    if totals:
+        ops.append(UpdateOne({"_id": "totals"}, {"$inc": totals, "$set": {"updated_at": now}}, upsert=True))
+    if daily:
+        ops.append(UpdateOne({"_id": stats_day_id()}, {"$inc": daily, "$set": {"updated_at": now}}, upsert=True))
+    if not ops:
+        return
+    try:
+        await db.stats.bulk_write(ops, ordered=False)
+    except PyMongoError as e:
+        logger.error(f"Stats update failed: {e}")
+
+def blueprint_stats(blueprint: Dict[str, Any], sign: int = 1) -> Dict[str, int]:
+    totals = {"blueprints": sign}
+    for layer in blueprint.get("layers", []):
+        totals[f"layers.{layer['layer_id']}.{layer.get('status') or 'not_started'}"] = sign
+        totals[f"layers.{layer['layer_id']}.progress_total"] = sign * (layer.get("progress_percent") or 0)
+    return totals
+
+def layer_transition(layer_id: str, before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, int]:
+    totals = {}
+    old_status = before.get("status") or "not_started"
+    new_status = after.get("status") or old_status
+    if new_status != old_status:
+        totals[f"layers.{layer_id}.{old_status}"] = -1
+        totals[f"layers.{layer_id}.{new_status}"] = 1
+    progress = (after.get("progress_percent") or 0) - (before.get("progress_percent") or 0)
+    if progress:
+        totals[f"layers.{layer_id}.progress_total"] = progress
+    return totals
+
+def record_layer_changes(changes: List[tuple]) -> None:
+    # changes: (layer_id, layer before the write, layer after it)
+    totals: Dict[str, int] = {}
+    completions = 0
+    for layer_id, before, after in changes:
+        for key, value in layer_transition(layer_id, before, after).items():
+            totals[key] = totals.get(key, 0) + value
+        if after.get("status") == "completed" and before.get("status") != "completed":
+            completions += 1
+    daily = {"layer_updates": len(changes)}
+    if completions:
+        daily["layer_completions"] = completions
+    spawn_background(bump_stats(totals, daily))
+
+async def mark_active(user_id: str) -> None:
+    # First sighting of a user on a UTC day counts them once as active
+    day = utc_day()
+    key = f"{user_id}:{day}"
+    if active_users_seen.get(key):
+        return
+    active_users_seen.set(key, True)
+    try:
+        result = await db.user_activity.update_one(
+            {"user_id": user_id, "day": day},
+            {"$setOnInsert": {"expires_at": datetime.now(timezone.utc) + timedelta(days=ACTIVITY_RETENTION_DAYS)}},
+            upsert=True
+        )
+    except PyMongoError as e:
+        logger.error(f"Activity update failed: {e}")
+        return
+    if result.upserted_id is not None:
+        await bump_stats({}, {"active_users": 1})
+
 # ============== AUTH ENDPOINTS ==============
 
 @api_router.post("/auth/session")
@@ -157,6 +1455,8 @@ async def process_session(request: Request, response: Response):
     if not session_id:
         raise HTTPException(status_code=400, detail="Missing session ID")
     
+    import httpx
+
     async with httpx.AsyncClient() as client_http:
         resp = await client_http.get(
             "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
@@ -184,37 +1484,29 @@ async def process_session(request: Request, response: Response):
             "created_at": datetime.now(timezone.utc).isoformat()
         }
         await db.users.insert_one(user_doc)
-        
+
         # Create initial blueprint for new user
-        default_layers = [
-            {"layer_id": "identity", "layer_name": "Identity Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "product", "layer_name": "Product Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "audience", "layer_name": "Audience Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "systems", "layer_name": "Systems Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "financial", "layer_name": "Financial Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "expansion", "layer_name": "Expansion Layer", "status": "not_started", "progress_percent": 0, "content": {}}
-        ]
-        blueprint_doc = {
-            "blueprint_id": f"bp_{uuid.uuid4().hex[:12]}",
-            "user_id": user_id,
-            "company_name": "",
-            "layers": default_layers,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.blueprints.insert_one(blueprint_doc)
+        blueprint = new_blueprint_doc(user_id)
+        await db.blueprints.insert_one(blueprint)
+        spawn_background(bump_stats({"users": 1, **blueprint_stats(blueprint)}, {"new_users": 1, "blueprints_created": 1}))
     
     session_token = data.get("session_token", f"st_{uuid.uuid4().hex}")
     expires_at = datetime.now(timezone.utc) + timedelta(days=7)
     
+    # Sessions for this user are replaced and the profile may have changed.
+    # Invalidating after the delete evicts anything cached before it; the
+    # generation bump stops lookups still in flight from caching afterwards.
     await db.user_sessions.delete_many({"user_id": user_id})
+    invalidate_cached_sessions(user_id=user_id)
     session_doc = {
         "user_id": user_id,
         "session_token": session_token,
-        "expires_at": expires_at.isoformat(),
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "expires_at": expires_at,
+        "created_at": datetime.now(timezone.utc)
     }
     await db.user_sessions.insert_one(session_doc)
+    spawn_background(bump_stats({}, {"logins": 1}))
+    spawn_background(mark_active(user_id))
     
     response.set_cookie(
         key="session_token",
@@ -238,178 +1530,1157 @@ async def get_me(request: Request):
 
 @api_router.post("/auth/logout")
 async def logout(request: Request, response: Response):
-    session_token = request.cookies.get("session_token")
+    session_token = get_session_token(request)
     if session_token:
         await db.user_sessions.delete_many({"session_token": session_token})
+        invalidate_cached_sessions(session_token=session_token)
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out"}
 
 # ============== BLUEPRINT ENDPOINTS ==============
 
+def new_blueprint_doc(user_id: str) -> Dict[str, Any]:
+    default_layers = [
+        {"layer_id": "identity", "layer_name": "Identity Layer", "status": "not_started", "progress_percent": 0, "content": {}},
+        {"layer_id": "product", "layer_name": "Product Layer", "status": "not_started", "progress_percent": 0, "content": {}},
+        {"layer_id": "audience", "layer_name": "Audience Layer", "status": "not_started", "progress_percent": 0, "content": {}},
+        {"layer_id": "systems", "layer_name": "Systems Layer", "status": "not_started", "progress_percent": 0, "content": {}},
+        {"layer_id": "financial", "layer_name": "Financial Layer", "status": "not_started", "progress_percent": 0, "content": {}},
+        {"layer_id": "expansion", "layer_name": "Expansion Layer", "status": "not_started", "progress_percent": 0, "content": {}}
+    ]
+    return {
+        "blueprint_id": f"bp_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "company_name": "",
+        "layers": default_layers,
+        "version": 1,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+# Every write to a blueprint bumps version alongside updated_at; together they
+# identify a representation for ETags and the PDF cache
+BLUEPRINT_VERSION_PROJECTION = {"_id": 0, "blueprint_id": 1, "version": 1, "updated_at": 1, "company_name": 1}
+
+def blueprint_etag(blueprint: Dict[str, Any], variant: str) -> str:
+    raw = f"{blueprint.get('blueprint_id')}:{blueprint.get('version', 0)}:{blueprint.get('updated_at')}"
+    return f'"{variant}-{hashlib.sha1(raw.encode()).hexdigest()[:20]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # Weak comparison: compression may have turned our tag into W/"..."
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in candidates or etag in candidates
+
+def set_blueprint_cache_headers(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+
+async def blueprint_not_modified(request: Request, user_id: str, variant: str) -> Optional[Response]:
+    # Answered from a projection of the version fields, without loading layer content
+    if not request.headers.get("if-none-match"):
+        return None
+    meta = await db.blueprints.find_one({"user_id": user_id}, BLUEPRINT_VERSION_PROJECTION)
+    if not meta:
+        return None
+    etag = blueprint_etag(meta, variant)
+    if not etag_matches(request, etag):
+        return None
+    response = Response(status_code=304)
+    set_blueprint_cache_headers(response, etag)
+    return response
+
 @api_router.get("/blueprint")
 async def get_blueprint(request: Request):
     user = await require_auth(request)
+    cached = await blueprint_not_modified(request, user.user_id, "blueprint")
+    if cached is not None:
+        return cached
+    
     blueprint = await db.blueprints.find_one({"user_id": user.user_id}, {"_id": 0})
     if not blueprint:
-        default_layers = [
-            {"layer_id": "identity", "layer_name": "Identity Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "product", "layer_name": "Product Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "audience", "layer_name": "Audience Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "systems", "layer_name": "Systems Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "financial", "layer_name": "Financial Layer", "status": "not_started", "progress_percent": 0, "content": {}},
-            {"layer_id": "expansion", "layer_name": "Expansion Layer", "status": "not_started", "progress_percent": 0, "content": {}}
-        ]
-        blueprint = {
-            "blueprint_id": f"bp_{uuid.uuid4().hex[:12]}",
-            "user_id": user.user_id,
-            "company_name": "",
-            "layers": default_layers,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }
+        blueprint = new_blueprint_doc(user.user_id)
         await db.blueprints.insert_one(blueprint)
-        del blueprint["_id"] if "_id" in blueprint else None
-    return blueprint
+        blueprint.pop("_id", None)
+        spawn_background(bump_stats(blueprint_stats(blueprint), {"blueprints_created": 1}))
+    response = json_response(blueprint)
+    set_blueprint_cache_headers(response, blueprint_etag(blueprint, "blueprint"))
+    return response
 
 @api_router.put("/blueprint/company-name")
 async def update_company_name(request: Request, data: BlueprintCreateRequest):
     user = await require_auth(request)
     await db.blueprints.update_one(
         {"user_id": user.user_id},
-        {"$set": {"company_name": data.company_name, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"company_name": data.company_name, "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}}
     )
     return {"message": "Company name updated"}
 
-@api_router.put("/blueprint/layer")
-async def update_layer(request: Request, data: LayerUpdateRequest):
-    user = await require_auth(request)
-    blueprint = await db.blueprints.find_one({"user_id": user.user_id}, {"_id": 0})
-    if not blueprint:
-        raise HTTPException(status_code=404, detail="Blueprint not found")
+def layer_update_fields(content: Dict[str, Any], status: Optional[str] = None) -> Dict[str, Any]:
+    # Progress is derived from the number of filled content fields
+    content_fields = len([v for v in content.values() if v])
+    progress_percent = min(100, content_fields * 20)
+    if progress_percent == 100:
+        status = "completed"
+    elif progress_percent > 0:
+        status = "in_progress"
+    fields = {
+        "content": content,
+        "progress_percent": progress_percent,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    if status:
+        fields["status"] = status
+    return fields
+
+async def save_layer(user_id: str, layer_id: str, fields: Dict[str, Any], source: str, return_layers: bool = False, **revision_fields):
+    # Only the matched layer is rewritten, server-side, so concurrent saves to
+    # different layers no longer clobber each other
+    update = {f"layers.$.{key}": value for key, value in fields.items()}
+    update["updated_at"] = fields["updated_at"]
     
-    layers = blueprint.get("layers", [])
-    for layer in layers:
-        if layer["layer_id"] == data.layer_id:
-            layer["content"] = data.content
-            if data.status:
-                layer["status"] = data.status
-            # Calculate progress based on content fields
-            content_fields = len([v for v in data.content.values() if v])
-            layer["progress_percent"] = min(100, content_fields * 20)
-            if layer["progress_percent"] == 100:
-                layer["status"] = "completed"
-            elif layer["progress_percent"] > 0:
-                layer["status"] = "in_progress"
-            layer["updated_at"] = datetime.now(timezone.utc).isoformat()
-            break
+    if return_layers:
+        projection = {"_id": 0, "layers": 1}
+    else:
+        projection = {"_id": 0, "layers": {"$elemMatch": {"layer_id": layer_id}}}
     
-    await db.blueprints.update_one(
-        {"user_id": user.user_id},
-        {"$set": {"layers": layers, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    # The pre-image gives the status transition for stats and the content the
+    # revision diff is taken against; the response is the same layer with the
+    # new fields applied
+    blueprint = await db.blueprints.find_one_and_update(
+        {"user_id": user_id, "layers.layer_id": layer_id},
+        {"$set": update, "$inc": {"version": 1, "layers.$.revision": 1}},
+        projection=projection,
+        return_document=ReturnDocument.BEFORE
     )
-    return {"message": "Layer updated", "layers": layers}
-
-# ============== AI CONTENT GENERATION ==============
+    if not blueprint:
+        if await db.blueprints.count_documents({"user_id": user_id}, limit=1):
+            raise HTTPException(status_code=404, detail="Layer not found")
+        raise HTTPException(status_code=404, detail="Blueprint not found")
+    
+    before = next((layer for layer in blueprint.get("layers", []) if layer["layer_id"] == layer_id), {})
+    fields = {**fields, "revision": (before.get("revision") or 0) + 1}
+    layers = [
+        {**layer, **fields} if layer["layer_id"] == layer_id else layer
+        for layer in blueprint.get("layers", [])
+    ]
+    layer = next((layer for layer in layers if layer["layer_id"] == layer_id), None)
+    record_layer_changes([(layer_id, before, layer)])
+    await record_layer_revisions(user_id, [(layer_id, before, layer)], source, **revision_fields)
+    return layer, layers
 
-@api_router.post("/generate/layer-content")
-async def generate_layer_content(request: Request, data: LayerContentRequest):
+@api_router.put("/blueprint/layer")
+async def update_layer(request: Request, data: LayerUpdateRequest):
     user = await require_auth(request)
-    
-    layer_prompts = {
-        "identity": f"""Generate startup identity content for {data.company_name or 'a startup'}:
-- Worldview: A unique perspective on the market (2-3 sentences)
-- Category POV: How this startup sees its category differently (2-3 sentences)
-- Brand Archetype: The personality type (e.g., The Innovator, The Sage, etc.)
-- Core Message: A powerful tagline or positioning statement
-- Values: 3-5 core values
+    fields = layer_update_fields(data.content, data.status)
+    layer, layers = await save_layer(user.user_id, data.layer_id, fields, "edit", data.return_layers)
+    result = {"message": "Layer updated", "layer": layer}
+    if data.return_layers:
+        result["layers"] = layers
+    return result
 
-User context: {data.prompt}
+# ============== LAYER REVISIONS ==============
 
-Return as JSON with keys: worldview, category_pov, brand_archetype, core_message, values (array)""",
-        
-        "product": f"""Generate product strategy content for {data.company_name or 'a startup'}:
-- Main Offer: The core product/service description
-- Pricing Strategy: Recommended pricing approach
-- 10x Feature: The one feature that makes this 10x better than alternatives
-- Signature Experience: What makes the customer experience unique
+# Every save of a layer's content gets a revision number (kept on the layer
+# itself and bumped in the same update) and one layer_revisions document. Most
+# documents hold only a diff against the previous revision; every
+# LAYER_REVISION_SNAPSHOT_EVERY-th, or any whose diff would not be smaller,
+# holds the full content. Rebuilding a revision starts at the nearest snapshot
+# at or before it and replays the diffs in between.
 
-User context: {data.prompt}
+def json_size(value: Any) -> int:
+    if orjson is not None:
+        return len(orjson.dumps(value))
+    return len(json.dumps(value, default=str))
 
-Return as JSON with keys: main_offer, pricing_strategy, ten_x_feature, signature_experience""",
-        
-        "audience": f"""Generate audience growth strategy for {data.company_name or 'a startup'}:
-- Target Audience: Detailed description of ideal customer
-- Distribution Channels: Top 3 channels to reach them
-- Content Strategy: Content pillars and approach
-- Growth Engine: The primary growth mechanism
+def json_diff(old: Any, new: Any, path: tuple = ()) -> List[Dict[str, Any]]:
+    # Nested objects are diffed key by key; anything else is replaced whole
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "unset", "path": [*path, key]} for key in old if key not in new]
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "set", "path": [*path, key], "value": value})
+            else:
+                ops.extend(json_diff(old[key], value, (*path, key)))
+        return ops
+    if old != new:
+        return [{"op": "set", "path": list(path), "value": new}]
+    return []
 
-User context: {data.prompt}
+def apply_json_diff(document: Any, ops: List[Dict[str, Any]]) -> Any:
+    for op in ops:
+        path = op["path"]
+        if not path:
+            document = op.get("value")
+            continue
+        parent = document
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        if op["op"] == "unset":
+            parent.pop(path[-1], None)
+        else:
+            parent[path[-1]] = op["value"]
+    return document
 
-Return as JSON with keys: target_audience, distribution_channels (array), content_strategy, growth_engine""",
-        
-        "systems": f"""Generate operational systems for {data.company_name or 'a startup'}:
+def layer_revision_doc(user_id: str, layer_id: str, revision: int, previous: Dict[str, Any], layer: Dict[str, Any], source: str, snapshot: bool = False) -> Dict[str, Any]:
+    content = layer.get("content") or {}
+    doc = {
+        "user_id": user_id,
+        "layer_id": layer_id,
+        "revision": revision,
+        "source": source,
+        "status": layer.get("status"),
+        "progress_percent": layer.get("progress_percent"),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    ops = json_diff(previous, content)
+    snapshot_size = json_size(content)
+    diff_size = json_size(ops)
+    if snapshot or revision % LAYER_REVISION_SNAPSHOT_EVERY == 0 or diff_size >= snapshot_size:
+        doc.update(kind="snapshot", content=content, size=snapshot_size)
+    else:
+        doc.update(kind="diff", ops=ops, size=diff_size)
+    doc["changes"] = len(ops)
+    return doc
+
+async def record_layer_revisions(user_id: str, changes: List[tuple], source: str, **extra) -> None:
+    # changes: (layer_id, layer before the write, layer after it). A layer saved
+    # before history existed gets its prior content kept as revision 0. Revision
+    # 1 is then a snapshot too, so it never depends on revision 0 having been
+    # written alongside it.
+    docs = []
+    for layer_id, before, after in changes:
+        previous = before.get("content") or {}
+        revision = (before.get("revision") or 0) + 1
+        baseline = revision == 1 and bool(previous)
+        if baseline:
+            docs.append(layer_revision_doc(user_id, layer_id, 0, {}, before, "baseline"))
+        docs.append({**layer_revision_doc(user_id, layer_id, revision, previous, after, source, snapshot=baseline), **extra})
+    if not docs:
+        return
+    # History is best effort: the layer itself is already saved
+    try:
+        await db.layer_revisions.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        logger.error(f"Layer revision write failed for {user_id}: {e.details.get('writeErrors', [])[:1]}")
+    except PyMongoError as e:
+        logger.error(f"Layer revision write failed for {user_id}: {e}")
+
+async def load_layer_revision(user_id: str, layer_id: str, revision: int) -> Dict[str, Any]:
+    target = await db.layer_revisions.find_one(
+        {"user_id": user_id, "layer_id": layer_id, "revision": revision},
+        {"_id": 0, "ops": 0, "content": 0}
+    )
+    if not target:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    
+    # Without a snapshot the chain starts from the empty layer
+    snapshot = await db.layer_revisions.find_one(
+        {"user_id": user_id, "layer_id": layer_id, "kind": "snapshot", "revision": {"$lte": revision}},
+        {"_id": 0, "revision": 1, "content": 1},
+        sort=[("revision", -1)]
+    )
+    content = snapshot["content"] if snapshot else {}
+    start = snapshot["revision"] if snapshot else 0
+    diffs = await db.layer_revisions.find(
+        {"user_id": user_id, "layer_id": layer_id, "revision": {"$gt": start, "$lte": revision}},
+        {"_id": 0, "revision": 1, "ops": 1}
+    ).sort("revision", ASCENDING).to_list(None)
+    if len(diffs) != revision - start:
+        raise HTTPException(status_code=410, detail="Revision history is incomplete, this revision cannot be rebuilt")
+    for diff in diffs:
+        content = apply_json_diff(content, diff["ops"])
+    
+    target.pop("kind", None)
+    target.pop("size", None)
+    return {**target, "content": content}
+
+@api_router.get("/blueprint/layers/{layer_id}/revisions")
+async def list_layer_revisions(request: Request, layer_id: str, before: Optional[int] = None, limit: int = LAYER_REVISION_PAGE_SIZE):
+    user = await require_auth(request)
+    limit = max(1, min(limit, LAYER_REVISION_PAGE_SIZE))
+    query: Dict[str, Any] = {"user_id": user.user_id, "layer_id": layer_id}
+    if before is not None:
+        query["revision"] = {"$lt": before}
+    revisions = await db.layer_revisions.find(
+        query,
+        {"_id": 0, "user_id": 0, "ops": 0, "content": 0}
+    ).sort("revision", -1).limit(limit + 1).to_list(limit + 1)
+    has_more = len(revisions) > limit
+    revisions = revisions[:limit]
+    return json_response({
+        "revisions": revisions,
+        "has_more": has_more,
+        "before": revisions[-1]["revision"] if revisions else before
+    })
+
+@api_router.get("/blueprint/layers/{layer_id}/revisions/{revision}")
+async def get_layer_revision(request: Request, layer_id: str, revision: int):
+    user = await require_auth(request)
+    return json_response(await load_layer_revision(user.user_id, layer_id, revision))
+
+@api_router.post("/blueprint/layers/{layer_id}/revisions/{revision}/restore")
+async def restore_layer_revision(request: Request, layer_id: str, revision: int):
+    user = await require_auth(request)
+    restored = await load_layer_revision(user.user_id, layer_id, revision)
+    # Restoring is a new save, so it is itself undoable
+    fields = layer_update_fields(restored["content"], restored.get("status"))
+    layer, _ = await save_layer(user.user_id, layer_id, fields, "restore", restored_from=revision)
+    return {"message": "Layer restored", "restored_from": revision, "layer": layer}
+
+# ============== LLM CLIENT ==============
+
+def llm_overloaded(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="AI service is busy, please retry shortly",
+        headers={"Retry-After": str(max(1, int(retry_after)))}
+    )
+
+def upstream_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+class LLMClient:
+    # One pooled AsyncOpenAI client per process. Calls beyond max_in_flight wait
+    # in a bounded queue; when the queue is full or the wait runs out the caller
+    # gets a 503 with Retry-After instead of piling more load on the provider.
+    def __init__(self, max_in_flight: int, max_queue: int, queue_wait: float, timeout: float, max_retries: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_wait = queue_wait
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.waiting = 0
+        self.retries = 0
+        self.rejected = 0
+        # Waiters queued per user and served round-robin
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._http = None
+        self._client = None
+
+    def start(self) -> None:
+        if self._client is not None:
+            return
+        # Imported on first use: openai is the slowest import in the app
+        import httpx
+        import openai
+
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_POOL_CONNECTIONS, max_keepalive_connections=LLM_POOL_CONNECTIONS),
+            timeout=httpx.Timeout(self.timeout, connect=10.0)
+        )
+        if not OPENAI_API_KEY:
+            logger.warning("OPENAI_API_KEY is not set; AI requests will fail unless OPENAI_BASE_URL accepts any key")
+        self._client = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY or "unset",
+            base_url=OPENAI_BASE_URL,
+            http_client=self._http,
+            max_retries=0,
+            timeout=self.timeout
+        )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._http = None
+
+    def _release(self) -> None:
+        # A freed slot goes straight to the next user in rotation, so one user's
+        # backlog cannot crowd out everyone queued behind it
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _discard_waiter(self, owner: str, waiter: asyncio.Future) -> None:
+        queue = self._queues.get(owner)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[owner]
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.in_flight < self.max_in_flight and not self.waiting:
+            # A free slot is taken without yielding to the event loop
+            self.in_flight += 1
+        elif self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise llm_overloaded(self.queue_wait)
+        else:
+            user = llm_user.get()
+            owner = user.user_id if user else ""
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(owner, deque()).append(waiter)
+            self.waiting += 1
+            try:
+                # The releasing call hands its slot over, in_flight included
+                await asyncio.wait_for(waiter, self.queue_wait)
+            except BaseException as e:
+                self._discard_waiter(owner, waiter)
+                if waiter.done() and not waiter.cancelled():
+                    # The slot arrived just as this caller gave up; pass it on
+                    self._release()
+                if isinstance(e, asyncio.TimeoutError):
+                    self.rejected += 1
+                    raise llm_overloaded(self.queue_wait)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    @staticmethod
+    def retryable(error: Exception) -> bool:
+        import openai
+
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    @staticmethod
+    def retry_delay(attempt: int, error: Exception) -> float:
+        retry_after = upstream_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, LLM_RETRY_MAX_SECONDS)
+        # Full jitter keeps a burst of rate-limited calls from retrying in lockstep
+        return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+    async def _create(self, **params):
+        self.start()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._client.chat.completions.create(**params)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.retryable(e):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.retry_delay(attempt, e))
+
+    @staticmethod
+    def record(endpoint: str, started: float, error: Optional[BaseException] = None, usage=None) -> None:
+        outcome = "ok" if error is None else "error"
+        llm_request_duration.observe(time.perf_counter() - started, endpoint=endpoint, outcome=outcome)
+        if error is not None:
+            llm_errors.inc(endpoint=endpoint, error=type(error).__name__)
+        if usage is not None:
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            llm_tokens.inc(prompt_tokens, endpoint=endpoint, kind="prompt")
+            llm_tokens.inc(completion_tokens, endpoint=endpoint, kind="completion")
+            LLMClient.charge(prompt_tokens, completion_tokens)
+
+    @staticmethod
+    def charge(prompt_tokens: int, completion_tokens: int) -> None:
+        user = llm_user.get()
+        if user is not None and prompt_tokens + completion_tokens > 0:
+            spawn_background(token_quota.charge(user.user_id, prompt_tokens, completion_tokens))
+
+    async def complete(self, endpoint: str = "other", timeout: Optional[float] = None, **params):
+        async with self.slot():
+            started = time.perf_counter()
+            try:
+                response = await self._create(timeout=timeout or self.timeout, **params)
+            except Exception as e:
+                self.record(endpoint, started, error=e)
+                raise
+            self.record(endpoint, started, usage=getattr(response, "usage", None))
+            return response
+
+    async def stream(self, endpoint: str = "other", timeout: Optional[float] = None, **params):
+        # Yields content deltas as the model produces them. Closing the generator
+        # (e.g. on client disconnect) closes the upstream response as well.
+        async with self.slot():
+            started = time.perf_counter()
+            usage = None
+            produced = 0
+            try:
+                stream = await self._create(
+                    stream=True, stream_options={"include_usage": True}, timeout=timeout or self.timeout, **params
+                )
+            except Exception as e:
+                self.record(endpoint, started, error=e)
+                raise
+            try:
+                async for chunk in stream:
+                    # The final chunk carries usage and no choices
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        produced += len(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                self.record(endpoint, started, error=e, usage=usage)
+                raise
+            else:
+                self.record(endpoint, started, usage=usage)
+            finally:
+                if usage is None:
+                    # Streams closed early, or from providers without stream
+                    # usage, are charged an estimate
+                    prompt = sum(estimate_tokens(m.get("content") or "") for m in params.get("messages", []))
+                    self.charge(prompt, produced // 4 + 1 if produced else 0)
+                await stream.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "waiting_users": len(self._queues),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "retries": self.retries,
+            "rejected": self.rejected,
+        }
+
+llm_client = LLMClient(LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_WAIT_SECONDS, LLM_TIMEOUT_SECONDS, LLM_MAX_RETRIES)
+
+async def chat_completion(**params):
+    return await llm_client.complete(**params)
+
+def chat_completion_stream(**params):
+    return llm_client.stream(**params)
+
+def llm_http_error(error: Exception) -> HTTPException:
+    # Upstream failures map to gateway statuses rather than a blanket 500
+    if isinstance(error, HTTPException):
+        return error
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        return llm_overloaded(upstream_retry_after(error) or LLM_RETRY_BASE_SECONDS * 2 ** LLM_MAX_RETRIES)
+    if isinstance(error, openai.APITimeoutError):
+        return HTTPException(status_code=504, detail="AI service timed out")
+    if isinstance(error, openai.APIConnectionError):
+        return HTTPException(status_code=502, detail="AI service unreachable")
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return HTTPException(status_code=502, detail="AI service error")
+    return HTTPException(status_code=500, detail=str(error))
+
+def sse_error(error: Exception) -> str:
+    http_error = llm_http_error(error)
+    return sse_event({"detail": http_error.detail, "status": http_error.status_code}, event="error")
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# ============== AI CONTENT GENERATION ==============
+
+LAYER_SYSTEM_PROMPT = "You are a startup strategy expert. Generate practical, actionable content. Always respond with valid JSON only, no markdown or explanation."
+
+def build_layer_prompt(layer_id: str, company_name: Optional[str], prompt: str) -> str:
+    layer_prompts = {
+        "identity": f"""Generate startup identity content for {company_name or 'a startup'}:
+- Worldview: A unique perspective on the market (2-3 sentences)
+- Category POV: How this startup sees its category differently (2-3 sentences)
+- Brand Archetype: The personality type (e.g., The Innovator, The Sage, etc.)
+- Core Message: A powerful tagline or positioning statement
+- Values: 3-5 core values
+
+User context: {prompt}
+
+Return as JSON with keys: worldview, category_pov, brand_archetype, core_message, values (array)""",
+
+        "product": f"""Generate product strategy content for {company_name or 'a startup'}:
+- Main Offer: The core product/service description
+- Pricing Strategy: Recommended pricing approach
+- 10x Feature: The one feature that makes this 10x better than alternatives
+- Signature Experience: What makes the customer experience unique
+
+User context: {prompt}
+
+Return as JSON with keys: main_offer, pricing_strategy, ten_x_feature, signature_experience""",
+
+        "audience": f"""Generate audience growth strategy for {company_name or 'a startup'}:
+- Target Audience: Detailed description of ideal customer
+- Distribution Channels: Top 3 channels to reach them
+- Content Strategy: Content pillars and approach
+- Growth Engine: The primary growth mechanism
+
+User context: {prompt}
+
+Return as JSON with keys: target_audience, distribution_channels (array), content_strategy, growth_engine""",
+
+        "systems": f"""Generate operational systems for {company_name or 'a startup'}:
 - CRM Approach: How to manage customer relationships
 - Automation Priorities: Top 3 processes to automate
 - Key Workflows: Essential business workflows
 - Tech Stack Recommendations: Core tools needed
 
-User context: {data.prompt}
+User context: {prompt}
 
 Return as JSON with keys: crm_approach, automation_priorities (array), key_workflows (array), tech_stack (array)""",
-        
-        "financial": f"""Generate financial strategy for {data.company_name or 'a startup'}:
+
+        "financial": f"""Generate financial strategy for {company_name or 'a startup'}:
 - Revenue Model: How the business makes money
 - Pricing Tiers: Recommended tier structure
 - Key Metrics: Top 5 metrics to track
 - Financial Projections: High-level growth scenarios
 
-User context: {data.prompt}
+User context: {prompt}
 
 Return as JSON with keys: revenue_model, pricing_tiers (array of objects with name and price), key_metrics (array), financial_projections""",
-        
-        "expansion": f"""Generate expansion strategy for {data.company_name or 'a startup'}:
+
+        "expansion": f"""Generate expansion strategy for {company_name or 'a startup'}:
 - Partnership Opportunities: Types of strategic partners
 - Ecosystem Vision: How to build an ecosystem
 - Scale Map: Phases of scaling
 - Category Leadership: How to become the category leader
 
-User context: {data.prompt}
+User context: {prompt}
 
 Return as JSON with keys: partnership_opportunities (array), ecosystem_vision, scale_map (array), category_leadership"""
     }
     
-    prompt = layer_prompts.get(data.layer_id, data.prompt)
-    
+    return layer_prompts.get(layer_id, prompt)
+
+GENERATABLE_LAYERS = ("identity", "product", "audience", "systems", "financial", "expansion")
+
+def repair_json_fragment(raw: str) -> str:
+    # Best-effort fixes for the usual LLM slips: trailing commas, single-quoted
+    # strings and output cut off mid-value by max_tokens
+    text = re.sub(r",\s*([\]}])", r"\1", raw.strip()).rstrip(",").rstrip()
+    if text.startswith("'") and text.endswith("'") and len(text) > 1:
+        text = '"' + text[1:-1].replace('"', '\\"') + '"'
+    closers = []
+    in_string = False
+    escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]" and closers:
+            closers.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r",\s*$", "", text)
+    return text + "".join(reversed(closers))
+
+def decode_json_field(key: str, raw: str) -> Dict[str, Any]:
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a startup strategy expert. Generate practical, actionable content. Always respond with valid JSON only, no markdown or explanation."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1500
+        return {"key": key, "value": json.loads(raw), "status": "ok"}
+    except ValueError:
+        pass
+    try:
+        return {"key": key, "value": json.loads(repair_json_fragment(raw)), "status": "repaired"}
+    except ValueError:
+        return {"key": key, "value": raw.strip(), "status": "malformed"}
+
+class IncrementalJSONFields:
+    # Scans a JSON object as it streams in and emits each top-level field as soon
+    # as its value is complete. Anything before the opening brace (markdown
+    # fences, prose) is skipped.
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self.started = False
+        self.done = False
+        self.fields: Dict[str, Dict[str, Any]] = {}
+
+    def _emit(self, end: int) -> Dict[str, Any]:
+        field = decode_json_field(self._key, self._buffer[self._value_start:end])
+        self.fields[self._key] = field
+        self._key = None
+        self._value_start = None
+        return field
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self._buffer += text
+        emitted = []
+        buffer = self._buffer
+        while self._pos < len(buffer) and not self.done:
+            ch = buffer[self._pos]
+            if not self.started:
+                if ch == "{":
+                    self.started = True
+                    self._depth = 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        try:
+                            self._key = json.loads(buffer[self._key_start:self._pos + 1])
+                        except ValueError:
+                            self._key = buffer[self._key_start + 1:self._pos]
+                        self._key_start = None
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = self._pos
+            elif ch == ":" and self._depth == 1 and self._key is not None and self._value_start is None:
+                self._value_start = self._pos + 1
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._value_start is not None:
+                        emitted.append(self._emit(self._pos))
+                    self.done = True
+            elif ch == "," and self._depth == 1 and self._value_start is not None:
+                emitted.append(self._emit(self._pos))
+            self._pos += 1
+        return emitted
+
+    def finish(self) -> List[Dict[str, Any]]:
+        # Output that stopped mid-object still yields its last, possibly repaired, field
+        if not self.done and self._value_start is not None:
+            self.done = True
+            return [self._emit(len(self._buffer))]
+        self.done = True
+        return []
+
+    def content(self) -> Dict[str, Any]:
+        return {key: field["value"] for key, field in self.fields.items()}
+
+    def malformed_fields(self) -> List[str]:
+        return [key for key, field in self.fields.items() if field["status"] == "malformed"]
+
+def parse_layer_content(response_text: str) -> Dict[str, Any]:
+    try:
+        content = json.loads(response_text)
+        if isinstance(content, dict):
+            return {"content": content}
+    except ValueError:
+        pass
+    # Salvage whatever fields are intact instead of discarding the whole answer
+    parser = IncrementalJSONFields()
+    parser.feed(response_text)
+    parser.finish()
+    if not parser.fields:
+        return {"content": {"raw_content": response_text}}
+    result = {"content": parser.content()}
+    malformed = parser.malformed_fields()
+    if malformed:
+        result["malformed_fields"] = malformed
+    return result
+
+def layer_completion_params(data: LayerContentRequest) -> Dict[str, Any]:
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": LAYER_SYSTEM_PROMPT},
+            {"role": "user", "content": build_layer_prompt(data.layer_id, data.company_name, data.prompt)}
+        ],
+        "temperature": 0.7,
+        "max_tokens": 1500
+    }
+
+async def cached_generation(data: LayerContentRequest, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if data.bypass_cache:
+        return None
+    if data.reuse_cached:
+        cached = await generation_cache.get(GenerationCache.key_for(params))
+        if cached is not None:
+            return cached
+    if data.reuse_similar and SEMANTIC_CACHE_ENABLED:
+        return semantic_cache.lookup(data.layer_id, data.company_name, data.prompt)
+    return None
+
+async def store_generation(data: LayerContentRequest, params: Dict[str, Any], result: Dict[str, Any]) -> None:
+    # Only clean answers are worth replaying
+    if data.bypass_cache or result.get("malformed_fields") or "raw_content" in result["content"]:
+        return
+    try:
+        # Prompt and company are kept so the semantic index can be rebuilt on startup
+        await generation_cache.set(
+            GenerationCache.key_for(params),
+            {"content": result["content"]},
+            layer_id=data.layer_id,
+            prompt=data.prompt,
+            company_name=data.company_name or ""
         )
-        
+    except PyMongoError as e:
+        logger.error(f"Generation cache write failed: {e}")
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache.add(data.layer_id, data.company_name, data.prompt, {"content": result["content"]})
+
+async def run_layer_generation(data: LayerContentRequest, params: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        response = await chat_completion(endpoint="generate_layer_content", **params)
         response_text = response.choices[0].message.content
-        
-        # Try to parse as JSON
-        import json
-        try:
-            content = json.loads(response_text)
-        except:
-            content = {"raw_content": response_text}
-        
-        return {"content": content}
+        result = parse_layer_content(response_text)
     except Exception as e:
         logger.error(f"AI generation error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise llm_http_error(e)
+    
+    await store_generation(data, params, result)
+    return result
 
-# ============== AI MENTOR CHAT ==============
+async def coalesced(key: str, fn):
+    try:
+        return await llm_single_flight.do(key, fn)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timed out waiting for the AI response")
 
-@api_router.post("/chat/mentor")
-async def mentor_chat(request: Request, data: ChatRequest):
+async def generate_one_layer(user: User, data: LayerContentRequest) -> Dict[str, Any]:
+    params = layer_completion_params(data)
+    
+    cached = await cached_generation(data, params)
+    if cached is not None:
+        return {**cached, "cached": True}
+    
+    # Double-clicks and duplicate tabs share one upstream call
+    key = f"layer:{user.user_id}:{GenerationCache.key_for(params)}"
+    return await coalesced(key, lambda: run_layer_generation(data, params))
+
+@api_router.post("/generate/layer-content")
+async def generate_layer_content(request: Request, data: LayerContentRequest):
     user = await require_auth(request)
+    await rate_limit(user, "generate")
+    return await generate_one_layer(user, data)
+
+async def persist_generated_layers(user_id: str, contents: Dict[str, Dict[str, Any]]) -> int:
+    # Layers are addressed by position so every layer lands in one update; the
+    # filter re-checks each position so a reordered array cannot be misapplied
+    blueprint = await db.blueprints.find_one(
+        {"user_id": user_id},
+        {"_id": 0, "layers.layer_id": 1, "layers.status": 1, "layers.progress_percent": 1, "layers.revision": 1, "layers.content": 1}
+    )
+    if not blueprint:
+        raise HTTPException(status_code=404, detail="Blueprint not found")
+    layers = blueprint.get("layers", [])
+    positions = {layer["layer_id"]: index for index, layer in enumerate(layers)}
+    
+    query = {"user_id": user_id}
+    update = {}
+    increments = {"version": 1}
+    changes = []
+    for layer_id, content in contents.items():
+        if layer_id not in positions:
+            continue
+        index = positions[layer_id]
+        before = layers[index]
+        # Status, progress and revision are checked too, so the recorded
+        # transition and revision diff are exact
+        query[f"layers.{index}.layer_id"] = layer_id
+        query[f"layers.{index}.status"] = before.get("status")
+        query[f"layers.{index}.progress_percent"] = before.get("progress_percent")
+        query[f"layers.{index}.revision"] = before.get("revision")
+        fields = layer_update_fields(content)
+        for key, value in fields.items():
+            update[f"layers.{index}.{key}"] = value
+        increments[f"layers.{index}.revision"] = 1
+        changes.append((layer_id, before, {**before, **fields}))
+    if not update:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    update["updated_at"] = datetime.now(timezone.utc).isoformat()
+    
+    # The guards no longer hold after the update, so the pre-image is read
+    previous = await db.blueprints.find_one_and_update(
+        query,
+        {"$set": update, "$inc": increments},
+        projection={"_id": 0, "version": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not previous:
+        raise HTTPException(status_code=409, detail="Blueprint changed while saving, please retry")
+    record_layer_changes(changes)
+    await record_layer_revisions(user_id, changes, "generate")
+    return previous.get("version", 0) + 1
+
+@api_router.post("/generate/layers")
+async def generate_layers(request: Request, data: LayerBatchRequest):
+    user = await require_auth(request)
+    layer_ids = list(dict.fromkeys(data.layer_ids or GENERATABLE_LAYERS))
+    unknown = [layer_id for layer_id in layer_ids if layer_id not in GENERATABLE_LAYERS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown layers: {', '.join(unknown)}")
+    if not layer_ids:
+        raise HTTPException(status_code=400, detail="No layers requested")
+    await rate_limit(user, "generate", cost=len(layer_ids))
+    
+    # The LLM client still bounds total in-flight calls; this keeps one
+    # request from taking every slot
+    limit = min(data.concurrency or GENERATE_LAYERS_CONCURRENCY, GENERATE_LAYERS_CONCURRENCY)
+    slots = asyncio.Semaphore(max(1, limit))
+    
+    async def generate(layer_id: str) -> Dict[str, Any]:
+        layer_request = LayerContentRequest(
+            layer_id=layer_id,
+            prompt=data.prompts.get(layer_id, data.prompt),
+            company_name=data.company_name,
+            reuse_cached=data.reuse_cached,
+            reuse_similar=data.reuse_similar,
+            bypass_cache=data.bypass_cache
+        )
+        async with slots:
+            try:
+                result = await generate_one_layer(user, layer_request)
+            except HTTPException as e:
+                return {"layer_id": layer_id, "status": "error", "detail": e.detail, "status_code": e.status_code}
+            except Exception as e:
+                logger.error(f"Batch generation error for {layer_id}: {e}")
+                return {"layer_id": layer_id, "status": "error", "detail": "Generation failed", "status_code": 500}
+        return {"layer_id": layer_id, "status": "ok", "cached": False, **result}
+    
+    async def events():
+        tasks = [asyncio.create_task(generate(layer_id)) for layer_id in layer_ids]
+        results = []
+        try:
+            # Results go out in completion order; closing the stream cancels the rest
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                results.append(result)
+                yield sse_event(result, event="layer")
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        summary = {
+            "completed": [r["layer_id"] for r in results if r["status"] == "ok"],
+            "failed": [r["layer_id"] for r in results if r["status"] != "ok"],
+            "persisted": []
+        }
+        # Unparseable answers are returned but not written into the blueprint
+        contents = {
+            r["layer_id"]: r["content"] for r in results
+            if r["status"] == "ok" and "raw_content" not in r["content"]
+        }
+        if data.persist and contents:
+            try:
+                summary["version"] = await persist_generated_layers(user.user_id, contents)
+                summary["persisted"] = list(contents)
+            except HTTPException as e:
+                summary["persist_error"] = e.detail
+            except PyMongoError as e:
+                logger.error(f"Persisting generated layers failed: {e}")
+                summary["persist_error"] = "Could not save generated layers"
+        yield sse_event(summary, event="done")
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@api_router.post("/generate/layer-content/stream")
+async def generate_layer_content_stream(request: Request, data: LayerContentRequest):
+    user = await require_auth(request)
+    await rate_limit(user, "generate")
+    params = layer_completion_params(data)
+    cached = await cached_generation(data, params)
+    
+    async def replay():
+        for key, value in cached["content"].items():
+            yield sse_event({"key": key, "value": value, "status": "ok"}, event="field")
+        yield sse_event({**cached, "malformed_fields": [], "cached": True}, event="done")
+    
+    async def events():
+        parser = IncrementalJSONFields()
+        chunks = []
+        try:
+            async with aclosing(chat_completion_stream(endpoint="generate_layer_content_stream", **params)) as deltas:
+                async for delta in deltas:
+                    if await request.is_disconnected():
+                        logger.info(f"Layer generation stream abandoned by {user.user_id}")
+                        return
+                    chunks.append(delta)
+                    for field in parser.feed(delta):
+                        yield sse_event(field, event="field")
+        except Exception as e:
+            logger.error(f"AI generation stream error: {e}")
+            yield sse_error(e)
+            return
+
+        for field in parser.finish():
+            yield sse_event(field, event="field")
+        if parser.fields:
+            result = {"content": parser.content(), "malformed_fields": parser.malformed_fields()}
+        else:
+            result = {"content": {"raw_content": "".join(chunks)}, "malformed_fields": []}
+        await store_generation(data, params, result)
+        yield sse_event(result, event="done")
+    
+    body = replay() if cached is not None else events()
+    return StreamingResponse(body, media_type="text/event-stream", headers=SSE_HEADERS)
+
+# ============== AI MENTOR CHAT ==============
+
+MENTOR_SYSTEM_PROMPT = """You are an expert startup mentor and advisor for New Era Servicez - a Startup Operating System.
+You help founders with:
+- Strategy and positioning
+- Product development
+- Growth and marketing
+- Operations and systems
+- Fundraising and finance
+- Scaling and expansion
+
+Be concise, practical, and actionable. Draw from best practices of successful startups.
+If relevant context about their business is provided, reference it in your advice."""
+
+SUMMARY_SYSTEM_PROMPT = "You maintain a running summary of a founder's conversation with their startup mentor. Keep the facts about their business, decisions made and open questions. Be brief and factual."
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English prose
+    return len(text) // 4 + 1
+
+def chat_state_entry(message: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "message_id": message["message_id"],
+        "role": message["role"],
+        "content": message["content"],
+        "tokens": estimate_tokens(message["content"])
+    }
+
+async def load_chat_state(user_id: str) -> Dict[str, Any]:
+    state = await db.chat_state.find_one({"user_id": user_id}, {"_id": 0})
+    if state:
+        return state
+    # First turn since conversation state was introduced: seed it from history once
+    history = await db.chat_messages.find(
+        {"user_id": user_id},
+        {"_id": 0}
+    ).sort([("created_at", -1), ("message_id", -1)]).limit(MENTOR_RECENT_MAX_MESSAGES).to_list(MENTOR_RECENT_MAX_MESSAGES)
+    history.reverse()
+    state = {"user_id": user_id, "summary": "", "recent": [chat_state_entry(m) for m in history], "version": 0}
+    await db.chat_state.update_one({"user_id": user_id}, {"$setOnInsert": state}, upsert=True)
+    return state
+
+def context_window(state: Dict[str, Any], reserved_tokens: int) -> List[Dict[str, Any]]:
+    # Newest messages that fit the budget; older ones live on in the summary
+    budget = MENTOR_CONTEXT_TOKEN_BUDGET - reserved_tokens - estimate_tokens(state.get("summary", ""))
+    window = []
+    for message in reversed(state.get("recent", [])):
+        budget -= message["tokens"]
+        if budget < 0:
+            break
+        window.append(message)
+    window.reverse()
+    return window
+
+class ChatMessageWriter:
+    # Write-behind queue for chat_messages: inserts from every user are batched
+    # into one insert_many per flush. Each message gets its _id when queued, so
+    # a retried batch hits duplicate keys instead of storing a message twice.
+    # Pending messages are merged into the same worker's history reads.
+    def __init__(self, enabled: bool, flush_interval: float, batch_size: int, max_pending: int):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending: List[tuple] = []
+        self._by_user: Dict[str, List[Dict[str, Any]]] = {}
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+
+    async def add(self, message: Dict[str, Any]) -> None:
+        if not self.enabled:
+            await db.chat_messages.insert_one(dict(message))
+            self.written += 1
+            return
+        if len(self._pending) >= self.max_pending:
+            # Backpressure: the caller waits for a flush rather than growing the queue
+            await self.flush()
+            if len(self._pending) >= self.max_pending:
+                raise HTTPException(status_code=503, detail="Chat storage is unavailable, please retry shortly")
+        self._pending.append((ObjectId(), message))
+        self._by_user.setdefault(message["user_id"], []).append(message)
+        self.queued += 1
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def pending_for(self, user_id: str) -> List[Dict[str, Any]]:
+        return list(self._by_user.get(user_id, []))
+
+    def _written(self, batch: List[tuple]) -> None:
+        del self._pending[:len(batch)]
+        for _, message in batch:
+            messages = self._by_user.get(message["user_id"])
+            if messages:
+                messages.remove(message)
+                if not messages:
+                    del self._by_user[message["user_id"]]
+
+    async def flush(self) -> None:
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                try:
+                    await db.chat_messages.insert_many([{"_id": oid, **message} for oid, message in batch], ordered=False)
+                except BulkWriteError as e:
+                    # Duplicate keys are messages a failed attempt already stored
+                    errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                    if errors:
+                        self.failures += 1
+                        logger.error(f"Dropped {len(errors)} chat messages: {errors[0].get('errmsg')}")
+                except PyMongoError as e:
+                    self.failures += 1
+                    logger.error(f"Chat message flush failed, will retry: {e}")
+                    return
+                self._written(batch)
+                self.written += len(batch)
+                self.batches += 1
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "queued": self.queued,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+        }
+
+chat_writer = ChatMessageWriter(CHAT_WRITE_BEHIND, CHAT_WRITE_FLUSH_SECONDS, CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_MAX_PENDING)
+
+def message_timestamp() -> datetime:
+    # BSON dates hold milliseconds; truncating up front makes a queued message
+    # compare equal to its stored copy, so history cursors match both
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+async def start_mentor_turn(user: User, data: ChatRequest):
+    state = await load_chat_state(user.user_id)
     
     # Save user message
     user_msg = {
@@ -417,91 +2688,270 @@ async def mentor_chat(request: Request, data: ChatRequest):
         "user_id": user.user_id,
         "role": "user",
         "content": data.message,
-        "created_at": datetime.now(timezone.utc).isoformat()
+        "created_at": message_timestamp()
     }
-    await db.chat_messages.insert_one(user_msg)
-    
-    # Get chat history for context
-    history = await db.chat_messages.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).limit(10).to_list(10)
-    history.reverse()
+    await chat_writer.add(user_msg)
     
-    history_text = "\n".join([f"{m['role']}: {m['content']}" for m in history[:-1]])
+    window = context_window(state, estimate_tokens(data.message))
+    history_text = "\n".join([f"{m['role']}: {m['content']}" for m in window])
+    if state.get("summary"):
+        history_text = f"Summary of earlier conversation: {state['summary']}\n\n{history_text}"
     
-    try:
-        full_prompt = f"""Previous conversation:
+    full_prompt = f"""Previous conversation:
 {history_text}
 
 User's current question: {data.message}
 
 {f"Business context: {data.context}" if data.context else ""}"""
-        
-        response = await openai.ChatCompletion.acreate(
+    
+    messages = [
+        {"role": "system", "content": MENTOR_SYSTEM_PROMPT},
+        {"role": "user", "content": full_prompt}
+    ]
+    return messages, user_msg
+
+async def save_assistant_message(user_id: str, content: str) -> Dict[str, Any]:
+    assistant_msg = {
+        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "role": "assistant",
+        "content": content,
+        "created_at": message_timestamp()
+    }
+    await chat_writer.add(assistant_msg)
+    return assistant_msg
+
+async def finish_mentor_turn(user_id: str, user_msg: Dict[str, Any], assistant_msg: Dict[str, Any]) -> None:
+    # The hard cap only bites if summarization keeps failing
+    state = await db.chat_state.find_one_and_update(
+        {"user_id": user_id},
+        {
+            "$push": {"recent": {
+                "$each": [chat_state_entry(user_msg), chat_state_entry(assistant_msg)],
+                "$slice": -2 * MENTOR_RECENT_MAX_MESSAGES
+            }},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        },
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    recent_tokens = sum(m["tokens"] for m in state["recent"])
+    if (recent_tokens + estimate_tokens(state.get("summary", "")) > MENTOR_CONTEXT_TOKEN_BUDGET
+            or len(state["recent"]) > MENTOR_RECENT_MAX_MESSAGES):
+        spawn_background(compact_chat_state(user_id))
+
+compacting_chat_states = set()
+
+async def compact_chat_state(user_id: str) -> None:
+    # Folds the oldest half of the recent window into the summary, off the request path
+    if user_id in compacting_chat_states:
+        return
+    compacting_chat_states.add(user_id)
+    try:
+        state = await db.chat_state.find_one({"user_id": user_id}, {"_id": 0})
+        if not state:
+            return
+        recent = state.get("recent", [])
+        keep_tokens = MENTOR_CONTEXT_TOKEN_BUDGET // 2
+        keep_messages = MENTOR_RECENT_MAX_MESSAGES // 2
+        kept = 0
+        split = len(recent)
+        while split > 0 and len(recent) - split < keep_messages and kept + recent[split - 1]["tokens"] <= keep_tokens:
+            split -= 1
+            kept += recent[split]["tokens"]
+        folded = recent[:split]
+        if not folded:
+            return
+
+        transcript = "\n".join([f"{m['role']}: {m['content']}" for m in folded])
+        response = await chat_completion(
+            endpoint="mentor_summary",
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": """You are an expert startup mentor and advisor for New Era Servicez - a Startup Operating System.
-You help founders with:
-- Strategy and positioning
-- Product development
-- Growth and marketing
-- Operations and systems
-- Fundraising and finance
-- Scaling and expansion
-
-Be concise, practical, and actionable. Draw from best practices of successful startups.
-If relevant context about their business is provided, reference it in your advice."""},
-                {"role": "user", "content": full_prompt}
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{state.get('summary') or '(none)'}\n\nNew messages:\n{transcript}\n\nReturn the updated summary."}
             ],
+            temperature=0.2,
+            max_tokens=MENTOR_SUMMARY_MAX_TOKENS
+        )
+        summary = response.choices[0].message.content.strip()
+
+        # The version guard drops this result if another worker compacted first
+        await db.chat_state.update_one(
+            {"user_id": user_id, "version": state.get("version", 0)},
+            {
+                "$set": {"summary": summary},
+                "$pull": {"recent": {"message_id": {"$in": [m["message_id"] for m in folded]}}},
+                "$inc": {"version": 1}
+            }
+        )
+    except Exception as e:
+        logger.error(f"Chat summary update failed for {user_id}: {e}")
+    finally:
+        compacting_chat_states.discard(user_id)
+
+async def run_mentor_turn(user: User, data: ChatRequest) -> Dict[str, Any]:
+    messages, user_msg = await start_mentor_turn(user, data)
+    
+    try:
+        response = await chat_completion(
+            endpoint="mentor_chat",
+            model="gpt-4o-mini",
+            messages=messages,
             temperature=0.7,
             max_tokens=1000
         )
-        
+
         response_text = response.choices[0].message.content
-        
-        # Save assistant response
-        assistant_msg = {
-            "message_id": f"msg_{uuid.uuid4().hex[:12]}",
-            "user_id": user.user_id,
-            "role": "assistant",
-            "content": response_text,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.chat_messages.insert_one(assistant_msg)
-        
+        assistant_msg = await save_assistant_message(user.user_id, response_text)
+        await finish_mentor_turn(user.user_id, user_msg, assistant_msg)
+
         return {"response": response_text}
     except Exception as e:
         logger.error(f"Mentor chat error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise llm_http_error(e)
+
+@api_router.post("/chat/mentor")
+async def mentor_chat(request: Request, data: ChatRequest):
+    user = await require_auth(request)
+    await rate_limit(user, "chat")
+    # A resubmitted question is answered (and stored) once
+    digest = hashlib.sha256(json.dumps([data.message, data.context]).encode()).hexdigest()
+    return await coalesced(f"mentor:{user.user_id}:{digest}", lambda: run_mentor_turn(user, data))
+
+@api_router.post("/chat/mentor/stream")
+async def mentor_chat_stream(request: Request, data: ChatRequest):
+    user = await require_auth(request)
+    await rate_limit(user, "chat")
+    messages, user_msg = await start_mentor_turn(user, data)
+    
+    async def events():
+        chunks = []
+        try:
+            async with aclosing(chat_completion_stream(
+                endpoint="mentor_chat_stream",
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000
+            )) as deltas:
+                async for delta in deltas:
+                    if await request.is_disconnected():
+                        # Leaving the block closes the upstream request
+                        logger.info(f"Mentor chat stream abandoned by {user.user_id}")
+                        return
+                    chunks.append(delta)
+                    yield sse_event({"delta": delta})
+        except Exception as e:
+            logger.error(f"Mentor chat stream error: {e}")
+            yield sse_error(e)
+            return
+
+        assistant_msg = await save_assistant_message(user.user_id, "".join(chunks))
+        await finish_mentor_turn(user.user_id, user_msg, assistant_msg)
+        yield sse_event({"message_id": assistant_msg["message_id"], "response": assistant_msg["content"]}, event="done")
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def history_key(message: Dict[str, Any]):
+    return (message["created_at"], message["message_id"])
+
+def encode_history_cursor(message: Dict[str, Any]) -> str:
+    payload = json.dumps([message["created_at"].isoformat(), message["message_id"]])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), message_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @api_router.get("/chat/history")
-async def get_chat_history(request: Request):
+async def get_chat_history(request: Request, before: Optional[str] = None, after: Optional[str] = None, limit: int = CHAT_HISTORY_PAGE_SIZE):
     user = await require_auth(request)
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+    
+    # Keyset pagination over (created_at, message_id): every page is an index
+    # range scan, however long the history is. Without a cursor the newest page is returned.
+    query: Dict[str, Any] = {"user_id": user.user_id}
+    cursor = after or before
+    if cursor:
+        created_at, message_id = decode_history_cursor(cursor)
+        op = "$gt" if after else "$lt"
+        query["$or"] = [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "message_id": {op: message_id}}
+        ]
+    direction = 1 if after else -1
+    # Taken before the query: a message flushed meanwhile shows up in both and is deduplicated
+    pending = chat_writer.pending_for(user.user_id)
     messages = await db.chat_messages.find(
-        {"user_id": user.user_id},
+        query,
         {"_id": 0}
-    ).sort("created_at", 1).to_list(100)
-    return {"messages": messages}
+    ).sort([("created_at", direction), ("message_id", direction)]).limit(limit + 1).to_list(limit + 1)
+    # Rows not yet migrated from ISO strings are read as dates so cursors and
+    # the merge with pending messages compare like with like
+    for message in messages:
+        message["created_at"] = parse_stored_date(message.get("created_at")) or EPOCH
+    
+    if pending:
+        # Read-your-writes for messages still in the write-behind queue
+        if cursor:
+            bound = (created_at, message_id)
+            pending = [m for m in pending if (history_key(m) > bound if after else history_key(m) < bound)]
+        seen = {m["message_id"] for m in messages}
+        messages.extend(m for m in pending if m["message_id"] not in seen)
+        messages.sort(key=history_key, reverse=direction < 0)
+        messages = messages[:limit + 1]
+    
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after:
+        messages.reverse()
+    
+    return json_response({
+        "messages": messages,
+        "has_more": has_more,
+        "before": encode_history_cursor(messages[0]) if messages else before,
+        "after": encode_history_cursor(messages[-1]) if messages else after
+    })
 
 # ============== EXPORT ENDPOINTS ==============
 
-@api_router.get("/export/pdf")
-async def export_pdf(request: Request):
-    user = await require_auth(request)
-    blueprint = await db.blueprints.find_one({"user_id": user.user_id}, {"_id": 0})
-    if not blueprint:
-        raise HTTPException(status_code=404, detail="Blueprint not found")
+_pdf_styles = None
+
+def pdf_styles() -> Dict[str, Any]:
+    # Built once per process (worker processes build their own copy)
+    global _pdf_styles
+    if _pdf_styles is None:
+        from reportlab.lib import colors
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+
+        styles = getSampleStyleSheet()
+        _pdf_styles = {
+            "title": ParagraphStyle('Title', parent=styles['Title'], fontSize=24, spaceAfter=30, textColor=colors.HexColor('#0F1113')),
+            "heading": ParagraphStyle('Heading', parent=styles['Heading1'], fontSize=16, spaceAfter=12, textColor=colors.HexColor('#00CFFF')),
+            "body": ParagraphStyle('Body', parent=styles['Normal'], fontSize=11, spaceAfter=8, textColor=colors.HexColor('#5E6366')),
+        }
+    return _pdf_styles
+
+def render_blueprint_pdf(blueprint: Dict[str, Any]) -> bytes:
+    # CPU-bound; runs in the PDF executor, never on the event loop
+    from reportlab.lib.pagesizes import letter
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+
+    styles = pdf_styles()
+    title_style = styles["title"]
+    heading_style = styles["heading"]
+    body_style = styles["body"]
     
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle('Title', parent=styles['Title'], fontSize=24, spaceAfter=30, textColor=colors.HexColor('#0F1113'))
-    heading_style = ParagraphStyle('Heading', parent=styles['Heading1'], fontSize=16, spaceAfter=12, textColor=colors.HexColor('#00CFFF'))
-    body_style = ParagraphStyle('Body', parent=styles['Normal'], fontSize=11, spaceAfter=8, textColor=colors.HexColor('#5E6366'))
-    
     story = []
     
     # Title
@@ -514,7 +2964,7 @@ async def export_pdf(request: Request):
     for layer in blueprint.get("layers", []):
         story.append(Paragraph(f"Layer: {layer['layer_name']}", heading_style))
         story.append(Paragraph(f"Status: {layer['status'].replace('_', ' ').title()} ({layer['progress_percent']}% complete)", body_style))
-        
+
         content = layer.get("content", {})
         if content:
             for key, value in content.items():
@@ -525,44 +2975,324 @@ async def export_pdf(request: Request):
                     else:
                         value_str = str(value)
                     story.append(Paragraph(f"<b>{formatted_key}:</b> {value_str}", body_style))
-        
+
         story.append(Spacer(1, 20))
     
     doc.build(story)
-    buffer.seek(0)
+    return buffer.getvalue()
+
+class PDFRenderer:
+    # Runs renders in a thread or process pool behind a bounded queue, caches the
+    # bytes per (user, blueprint version) and coalesces identical renders.
+    def __init__(self, executor_kind: str, workers: int, max_pending: int, timeout: float):
+        self.executor_kind = executor_kind
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+        self.cache = TTLCache("pdf", PDF_CACHE_MAX_ENTRIES, PDF_CACHE_TTL_SECONDS, max_bytes=PDF_CACHE_MAX_BYTES, sizeof=len)
+        self.single_flight = SingleFlight("pdf_single_flight", timeout)
+
+    def executor(self):
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf")
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _render(self, key, blueprint: Dict[str, Any]) -> bytes:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="PDF export is busy, please retry shortly", headers={"Retry-After": "5"})
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            pdf = await loop.run_in_executor(self.executor(), render_blueprint_pdf, blueprint)
+        finally:
+            self.pending -= 1
+        self.cache.set(key, pdf)
+        return pdf
+
+    async def render(self, key, load_blueprint) -> bytes:
+        pdf = self.cache.get(key)
+        if pdf is not None:
+            return pdf
+
+        async def load_and_render():
+            return await self._render(key, await load_blueprint())
+
+        try:
+            return await self.single_flight.do(repr(key), load_and_render)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="PDF export timed out")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executor": self.executor_kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+        }
+
+pdf_renderer = PDFRenderer(PDF_RENDER_EXECUTOR, PDF_RENDER_WORKERS, PDF_RENDER_MAX_PENDING, PDF_RENDER_TIMEOUT_SECONDS)
+
+@api_router.get("/export/pdf")
+async def export_pdf(request: Request):
+    user = await require_auth(request)
+    # Only the version fields are read up front; layer content is loaded on a cache miss
+    meta = await db.blueprints.find_one({"user_id": user.user_id}, BLUEPRINT_VERSION_PROJECTION)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Blueprint not found")
+    etag = blueprint_etag(meta, "pdf")
+    if etag_matches(request, etag):
+        not_modified = Response(status_code=304)
+        set_blueprint_cache_headers(not_modified, etag)
+        return not_modified
+    await rate_limit(user, "export")
     
-    return StreamingResponse(
-        buffer,
+    async def load_blueprint():
+        blueprint = await db.blueprints.find_one({"user_id": user.user_id}, {"_id": 0})
+        if not blueprint:
+            raise HTTPException(status_code=404, detail="Blueprint not found")
+        return blueprint
+    
+    pdf = await pdf_renderer.render((user.user_id, etag), load_blueprint)
+    company_name = meta.get("company_name") or "Your Startup"
+    
+    response = Response(
+        content=pdf,
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename={company_name.replace(' ', '_')}_blueprint.pdf"}
     )
+    set_blueprint_cache_headers(response, etag)
+    return response
 
 @api_router.get("/export/json")
 async def export_json(request: Request):
     user = await require_auth(request)
+    cached = await blueprint_not_modified(request, user.user_id, "blueprint")
+    if cached is not None:
+        return cached
     blueprint = await db.blueprints.find_one({"user_id": user.user_id}, {"_id": 0})
     if not blueprint:
         raise HTTPException(status_code=404, detail="Blueprint not found")
-    return blueprint
+    response = json_response(blueprint)
+    set_blueprint_cache_headers(response, blueprint_etag(blueprint, "blueprint"))
+    return response
 
 # ============== WAITLIST ENDPOINTS ==============
 
 @api_router.post("/waitlist")
 async def join_waitlist(data: WaitlistRequest):
-    existing = await db.waitlist.find_one({"email": data.email}, {"_id": 0})
-    if existing:
-        return {"message": "Already on waitlist", "entry": existing}
-    
     entry = {
         "entry_id": f"wl_{uuid.uuid4().hex[:12]}",
         "email": data.email,
         "name": data.name,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.waitlist.insert_one(entry)
-    del entry["_id"] if "_id" in entry else None
+    # One upsert both dedupes and inserts; the unique email index settles races
+    try:
+        existing = await db.waitlist.find_one_and_update(
+            {"email": data.email},
+            {"$setOnInsert": entry},
+            projection={"_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        existing = await db.waitlist.find_one({"email": data.email}, {"_id": 0})
+    if existing:
+        return {"message": "Already on waitlist", "entry": existing}
     return {"message": "Successfully joined waitlist", "entry": entry}
 
+async def iter_lines(request: Request):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+async def iter_waitlist_rows(request: Request, fmt: str):
+    header = None
+    async for line in iter_lines(request):
+        if not line.strip():
+            continue
+        if fmt == "ndjson":
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+        elif header is None:
+            header = [column.strip().lower() for column in next(csv.reader([line]))]
+        else:
+            yield dict(zip(header, next(csv.reader([line]))))
+
+async def insert_waitlist_batch(batch: List[Dict[str, Any]], totals: Dict[str, int]) -> None:
+    try:
+        result = await db.waitlist.insert_many(batch, ordered=False)
+        totals["inserted"] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        details = e.details
+        duplicates = len([err for err in details.get("writeErrors", []) if err.get("code") == 11000])
+        totals["inserted"] += details.get("nInserted", 0)
+        totals["duplicates"] += duplicates
+        totals["failed"] += len(details.get("writeErrors", [])) - duplicates
+
+@api_router.post("/waitlist/import")
+async def import_waitlist(request: Request, format: Optional[str] = None):
+    await require_admin(request)
+    fmt = format or ("ndjson" if "ndjson" in request.headers.get("content-type", "") else "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    # Dedupe is delegated to the unique email index; without it duplicates would slip in
+    if index_status.get("waitlist.email_unique", {}).get("state") != "ready":
+        raise HTTPException(status_code=503, detail="Waitlist email index is not ready", headers={"Retry-After": "30"})
+    
+    totals = {"received": 0, "inserted": 0, "duplicates": 0, "invalid": 0, "failed": 0}
+    batch = []
+    now = datetime.now(timezone.utc).isoformat()
+    async for row in iter_waitlist_rows(request, fmt):
+        totals["received"] += 1
+        email = str((row or {}).get("email") or "").strip()
+        if not email:
+            totals["invalid"] += 1
+            continue
+        batch.append({
+            "entry_id": f"wl_{uuid.uuid4().hex[:12]}",
+            "email": email,
+            "name": row.get("name") or None,
+            "created_at": row.get("created_at") or now
+        })
+        if len(batch) >= WAITLIST_IMPORT_BATCH_SIZE:
+            await insert_waitlist_batch(batch, totals)
+            batch = []
+    if batch:
+        await insert_waitlist_batch(batch, totals)
+    return totals
+
+@api_router.get("/waitlist/export")
+async def export_waitlist(request: Request, format: str = "ndjson"):
+    await require_admin(request)
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    
+    async def rows():
+        # Streams straight off the cursor so memory stays flat however long the list is
+        cursor = db.waitlist.find({}, {"_id": 0}, batch_size=WAITLIST_IMPORT_BATCH_SIZE)
+        if format == "csv":
+            columns = ["entry_id", "email", "name", "created_at"]
+            buffer = StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            async for entry in cursor:
+                writer.writerow([entry.get(column) or "" for column in columns])
+                if buffer.tell() >= 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        else:
+            lines = []
+            async for entry in cursor:
+                lines.append(json.dumps(entry, default=str))
+                if len(lines) >= WAITLIST_IMPORT_BATCH_SIZE:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+            if lines:
+                yield "\n".join(lines) + "\n"
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        rows(),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=waitlist.{format}"}
+    )
+
+# ============== ADMIN STATS ==============
+
+STATS_LAYER_STATUSES = ("not_started", "in_progress", "completed")
+
+@api_router.get("/admin/stats")
+async def admin_stats(request: Request, days: int = 30):
+    await require_admin(request)
+    days = max(1, min(days, ACTIVITY_RETENTION_DAYS))
+    today = datetime.now(timezone.utc).date()
+    day_ids = [stats_day_id((today - timedelta(days=offset)).isoformat()) for offset in range(days)]
+    
+    # Two point reads, whatever the number of users and blueprints
+    totals = await db.stats.find_one({"_id": "totals"}, {"_id": 0}) or {}
+    daily_docs = await db.stats.find({"_id": {"$in": day_ids}}).to_list(days)
+    daily_by_id = {doc.pop("_id"): doc for doc in daily_docs}
+    
+    blueprints = totals.get("blueprints", 0)
+    layers = {}
+    progress_total = 0
+    for layer_id in GENERATABLE_LAYERS:
+        counts = totals.get("layers", {}).get(layer_id, {})
+        progress_total += counts.get("progress_total", 0)
+        layers[layer_id] = {
+            **{status: counts.get(status, 0) for status in STATS_LAYER_STATUSES},
+            "completion_rate": round(counts.get("completed", 0) / blueprints, 4) if blueprints else 0.0,
+            "avg_progress": round(counts.get("progress_total", 0) / blueprints, 2) if blueprints else 0.0,
+        }
+    
+    daily = []
+    for day_id in reversed(day_ids):
+        doc = daily_by_id.get(day_id, {})
+        doc.pop("updated_at", None)
+        daily.append({"day": day_id.split(":", 1)[1], **doc})
+    
+    return json_response({
+        "users": totals.get("users", 0),
+        "blueprints": blueprints,
+        "avg_progress": round(progress_total / (blueprints * len(GENERATABLE_LAYERS)), 2) if blueprints else 0.0,
+        "layers": layers,
+        "daily": daily,
+        "updated_at": totals.get("updated_at"),
+    })
+
+@api_router.post("/admin/stats/rebuild")
+async def rebuild_admin_stats(request: Request):
+    # Full recount for backfills and drift; increments landing mid-rebuild may be lost
+    await require_admin(request)
+    pipeline = [
+        {"$unwind": "$layers"},
+        {"$group": {
+            "_id": {"layer_id": "$layers.layer_id", "status": "$layers.status"},
+            "count": {"$sum": 1},
+            "progress": {"$sum": "$layers.progress_percent"}
+        }}
+    ]
+    layers: Dict[str, Dict[str, int]] = {}
+    async for row in db.blueprints.aggregate(pipeline):
+        counts = layers.setdefault(row["_id"]["layer_id"], {"progress_total": 0})
+        counts[row["_id"].get("status") or "not_started"] = counts.get(row["_id"].get("status") or "not_started", 0) + row["count"]
+        counts["progress_total"] += row["progress"] or 0
+    totals = {
+        "users": await db.users.count_documents({}),
+        "blueprints": await db.blueprints.count_documents({}),
+        "layers": layers,
+        "updated_at": datetime.now(timezone.utc),
+    }
+    await db.stats.replace_one({"_id": "totals"}, totals, upsert=True)
+    return json_response(totals)
+
 # ============== HEALTH CHECK ==============
 
 @api_router.get("/")
@@ -573,6 +3303,76 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@api_router.get("/health/indexes")
+async def health_indexes(request: Request):
+    await require_diagnostics(request)
+    states = {status["state"] for status in index_status.values()}
+    if "failed" in states:
+        overall = "degraded"
+    elif states == {"ready"}:
+        overall = "ready"
+    else:
+        overall = "building"
+    usage = await index_usage()
+    indexes = {
+        key: {**status, "ops": usage.get(key)}
+        for key, status in index_status.items()
+    }
+    return {"status": overall, "indexes": indexes}
+
+@api_router.get("/health/caches")
+async def health_caches(request: Request):
+    await require_diagnostics(request)
+    return {"caches": {name: cache.stats() for name, cache in cache_registry.items()}}
+
+@api_router.get("/health/llm")
+async def health_llm(request: Request):
+    await require_diagnostics(request)
+    return llm_client.stats()
+
+@api_router.get("/health/pdf")
+async def health_pdf(request: Request):
+    await require_diagnostics(request)
+    return pdf_renderer.stats()
+
+@api_router.get("/health/chat-writes")
+async def health_chat_writes(request: Request):
+    await require_diagnostics(request)
+    return chat_writer.stats()
+
+@api_router.get("/health/rate-limits")
+async def health_rate_limits(request: Request):
+    await require_diagnostics(request)
+    return {"enabled": RATE_LIMIT_ENABLED, "requests": request_limiter.stats(), "tokens": token_quota.stats()}
+
+# ============== METRICS ENDPOINT ==============
+
+def numeric_stats(source: Dict[str, Any], **labels):
+    return [
+        ({**labels, "stat": key}, value)
+        for key, value in source.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+CallbackGauge(
+    "cache_stat", "Cache and single-flight counters as reported by /api/health/caches", ("cache", "stat"),
+    lambda: [sample for name, cache in cache_registry.items() for sample in numeric_stats(cache.stats(), cache=name)]
+)
+CallbackGauge(
+    "llm_client_stat", "LLM client slots, queue and retry counters", ("stat",),
+    lambda: numeric_stats(llm_client.stats())
+)
+CallbackGauge(
+    "pdf_renderer_stat", "PDF render pool occupancy and rejections", ("stat",),
+    lambda: numeric_stats(pdf_renderer.stats())
+)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # Include router and middleware
 app.include_router(api_router)
 
@@ -584,6 +3384,106 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+
+# Outermost, so latency includes compression and CORS handling
+app.add_middleware(MetricsMiddleware)
+
+background_tasks = set()
+# Loops that only end when cancelled
+service_tasks = set()
+
+def spawn_background(coro, service: bool = False):
+    # Keep a strong reference so the task is not garbage collected mid-flight
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    if service:
+        service_tasks.add(task)
+        task.add_done_callback(service_tasks.discard)
+    return task
+
+@app.on_event("startup")
+async def bootstrap_indexes():
+    # Builds run in the background so a large collection does not hold up startup
+    spawn_background(ensure_indexes())
+
+# Modules the AI and PDF paths import on first use
+WARMUP_MODULES = ("httpx", "openai", "reportlab.platypus", "reportlab.lib.styles")
+
+async def warm_up():
+    # Pays the deferred import cost after the port is open instead of on the
+    # first AI or PDF request
+    started = time.perf_counter()
+    for name in WARMUP_MODULES + (("numpy",) if SEMANTIC_CACHE_ENABLED else ()):
+        await asyncio.to_thread(importlib.import_module, name)
+    await asyncio.to_thread(pdf_styles)
+    llm_client.start()
+    logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+async def load_semantic_cache():
+    try:
+        loaded = await semantic_cache.load("generation_cache")
+        logger.info(f"Semantic cache loaded {loaded} prompts")
+    except PyMongoError as e:
+        logger.error(f"Semantic cache load failed: {e}")
+
+@app.on_event("startup")
+async def start_semantic_cache():
+    if SEMANTIC_CACHE_ENABLED:
+        spawn_background(load_semantic_cache())
+
+@app.on_event("startup")
+async def start_chat_writer():
+    if CHAT_WRITE_BEHIND:
+        spawn_background(chat_writer.run(), service=True)
+
+@app.on_event("startup")
+async def start_warm_up():
+    if STARTUP_WARMUP:
+        spawn_background(warm_up())
+
+@app.on_event("startup")
+async def start_event_loop_monitor():
+    spawn_background(monitor_event_loop_lag(), service=True)
+
+@app.on_event("startup")
+async def start_rate_limit_flusher():
+    if RATE_LIMIT_PERSIST:
+        spawn_background(request_limiter.run_flusher(), service=True)
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    # Runs first, so the final flushes below do not race the periodic ones.
+    # Loops are cancelled; one-shot work such as stats and usage writes gets a
+    # short grace period before it is cancelled too.
+    for task in list(service_tasks):
+        task.cancel()
+    tasks = list(background_tasks)
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=BACKGROUND_SHUTDOWN_SECONDS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def flush_rate_limits():
+    if RATE_LIMIT_PERSIST:
+        await request_limiter.flush()
+
+@app.on_event("shutdown")
+async def shutdown_llm_client():
+    await llm_client.close()
+
+@app.on_event("shutdown")
+async def shutdown_pdf_renderer():
+    pdf_renderer.shutdown()
+
+@app.on_event("shutdown")
+async def flush_chat_messages():
+    await chat_writer.flush()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
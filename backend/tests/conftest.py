@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# server reads these at import time; tests that need a database swap in mongomock
+os.environ.setdefault("MONGO_URL", "mongodb://127.0.0.1:27017")
+os.environ.setdefault("DB_NAME", "tests")
+os.environ.setdefault("STARTUP_WARMUP", "false")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SESSION_TOKEN = "test-session"
+
+
+def fake_completion(**params):
+    content = json.dumps({"summary": "Generated", "key_points": ["one", "two"], "next_steps": ["three"]})
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    # App client on an in-memory database with one free-tier user signed in and
+    # the LLM replaced by a canned JSON answer
+    from mongomock_motor import AsyncMongoMockClient
+    from starlette.testclient import TestClient
+
+    import server
+
+    client = AsyncMongoMockClient(tz_aware=True)
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", client["tests"])
+    monkeypatch.setattr(server, "request_limiter", server.TokenBucketLimiter(1000, False, 5.0))
+    # Each TestClient runs its own event loop; the writer's lock and event bind to one
+    monkeypatch.setattr(server, "chat_writer", server.ChatMessageWriter(
+        server.CHAT_WRITE_BEHIND, server.CHAT_WRITE_FLUSH_SECONDS, server.CHAT_WRITE_BATCH_SIZE, server.CHAT_WRITE_MAX_PENDING
+    ))
+
+    async def completion(**params):
+        return fake_completion(**params)
+
+    monkeypatch.setattr(server, "chat_completion", completion)
+
+    async def seed():
+        await server.db.users.insert_one({"user_id": "user_1", "email": "user@example.com", "name": "User", "tier": "free"})
+        await server.db.user_sessions.insert_one({
+            "user_id": "user_1",
+            "session_token": SESSION_TOKEN,
+            "expires_at": datetime.now(timezone.utc) + timedelta(days=1),
+        })
+
+    with TestClient(server.app) as test_client:
+        test_client.portal.call(seed)
+        test_client.headers["Authorization"] = f"Bearer {SESSION_TOKEN}"
+        yield test_client
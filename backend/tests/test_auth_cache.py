@@ -0,0 +1,59 @@
+import asyncio
+
+from starlette.requests import Request
+
+import server
+from conftest import SESSION_TOKEN
+
+
+class Proxy:
+    def __init__(self, target, **overrides):
+        self._target = target
+        self._overrides = overrides
+
+    def __getattr__(self, name):
+        return self._overrides.get(name) or getattr(self._target, name)
+
+    def __getitem__(self, name):
+        return self._overrides.get(name) or self._target[name]
+
+
+def session_request():
+    return Request({"type": "http", "headers": [(b"authorization", f"Bearer {SESSION_TOKEN}".encode())]})
+
+
+def test_logout_during_lookup_is_not_cached(api, monkeypatch):
+    real_db = server.db
+
+    async def scenario():
+        reached = asyncio.Event()
+        gate = asyncio.Event()
+
+        class SlowUsers:
+            # Holds the lookup after it has read the session document
+            async def find_one(self, *args, **kwargs):
+                reached.set()
+                await gate.wait()
+                return await real_db.users.find_one(*args, **kwargs)
+
+        monkeypatch.setattr(server, "db", Proxy(real_db, users=SlowUsers()))
+        lookup = asyncio.create_task(server.get_current_user(session_request()))
+        await reached.wait()
+        monkeypatch.setattr(server, "db", real_db)
+
+        await real_db.user_sessions.delete_many({"session_token": SESSION_TOKEN})
+        server.invalidate_cached_sessions(session_token=SESSION_TOKEN)
+        gate.set()
+        await lookup
+        return server.auth_cache.get(SESSION_TOKEN)
+
+    assert api.portal.call(scenario) is None
+    assert api.get("/api/auth/me").status_code == 401
+
+
+def test_logout_evicts_cached_session(api):
+    assert api.get("/api/auth/me").status_code == 200
+    assert server.auth_cache.get(SESSION_TOKEN) is not None
+    assert api.post("/api/auth/logout").status_code == 200
+    assert server.auth_cache.get(SESSION_TOKEN) is None
+    assert api.get("/api/auth/me").status_code == 401
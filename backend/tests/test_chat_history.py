@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+import server
+
+
+def insert_messages(api, *messages):
+    async def insert():
+        await server.db.chat_messages.insert_many([dict(message) for message in messages])
+
+    api.portal.call(insert)
+
+
+def message(message_id, created_at, content="hi"):
+    return {"message_id": message_id, "user_id": "user_1", "role": "user", "content": content, "created_at": created_at}
+
+
+def test_history_reads_legacy_string_dates(api):
+    insert_messages(
+        api,
+        message("msg_a", "2024-01-01T10:00:00+00:00"),
+        message("msg_b", "2024-01-01T11:00:00"),
+        message("msg_c", datetime(2024, 1, 1, 12, tzinfo=timezone.utc)),
+    )
+    response = api.get("/api/chat/history?limit=2")
+    assert response.status_code == 200
+    page = response.json()
+    assert [m["message_id"] for m in page["messages"]] == ["msg_b", "msg_c"]
+    assert page["has_more"]
+
+    older = api.get(f"/api/chat/history?limit=2&before={page['before']}")
+    assert older.status_code == 200
+
+
+def test_history_merges_pending_messages_with_legacy_rows(api):
+    insert_messages(api, message("msg_old", "2024-01-01T10:00:00Z"))
+    api.portal.call(server.chat_writer.add, message("msg_new", server.message_timestamp()))
+    response = api.get("/api/chat/history")
+    assert response.status_code == 200
+    assert [m["message_id"] for m in response.json()["messages"]] == ["msg_old", "msg_new"]
+
+
+def test_unparseable_history_date_does_not_fail_the_page(api):
+    insert_messages(api, message("msg_bad", "yesterday-ish"), message("msg_ok", "2024-01-01T10:00:00+00:00"))
+    response = api.get("/api/chat/history")
+    assert response.status_code == 200
+    assert {m["message_id"] for m in response.json()["messages"]} == {"msg_bad", "msg_ok"}
+
+
+def test_migration_converts_every_string_date(api):
+    bad_id = ObjectId()
+    insert_messages(
+        api,
+        message("msg_a", "2024-01-01T10:00:00+00:00"),
+        {**message("msg_bad", "not a date"), "_id": bad_id},
+    )
+
+    async def migrate():
+        converted = await server.migrate_iso_dates("chat_messages", "created_at")
+        remaining = await server.db.chat_messages.count_documents({"created_at": {"$type": "string"}})
+        bad = await server.db.chat_messages.find_one({"_id": bad_id})
+        return converted, remaining, bad
+
+    converted, remaining, bad = api.portal.call(migrate)
+    assert converted == 2
+    assert remaining == 0
+    assert bad["created_at_unparsed"] == "not a date"
+    assert bad["created_at"] == bad_id.generation_time
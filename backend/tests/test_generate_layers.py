@@ -0,0 +1,53 @@
+import json
+
+import server
+
+
+def sse_events(text):
+    events = []
+    for frame in text.strip().split("\n\n"):
+        event, data = "message", None
+        for line in frame.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        events.append((event, data))
+    return events
+
+
+def test_default_request_generates_every_layer(api):
+    response = api.post("/api/generate/layers", json={"prompt": "A bakery"})
+    assert response.status_code == 200
+
+    events = sse_events(response.text)
+    layers = [data for event, data in events if event == "layer"]
+    assert sorted(layer["layer_id"] for layer in layers) == sorted(server.GENERATABLE_LAYERS)
+    assert all(layer["status"] == "ok" for layer in layers)
+    assert all(layer["content"]["summary"] == "Generated" for layer in layers)
+
+    assert events[-1][0] == "done"
+    summary = events[-1][1]
+    assert sorted(summary["completed"]) == sorted(server.GENERATABLE_LAYERS)
+    assert summary["failed"] == []
+    assert summary["persisted"] == []
+
+
+def test_default_request_persists_into_the_blueprint(api):
+    blueprint = api.get("/api/blueprint").json()
+    version = blueprint.get("version", 0)
+
+    response = api.post("/api/generate/layers", json={"prompt": "A bakery", "persist": True})
+    summary = sse_events(response.text)[-1][1]
+    assert sorted(summary["persisted"]) == sorted(server.GENERATABLE_LAYERS)
+    assert summary["version"] == version + 1
+
+    layers = api.get("/api/blueprint").json()["layers"]
+    generated = [layer for layer in layers if layer["layer_id"] in server.GENERATABLE_LAYERS]
+    assert all(layer["content"]["summary"] == "Generated" for layer in generated)
+
+
+def test_unknown_layer_is_rejected(api):
+    response = api.post("/api/generate/layers", json={"layer_ids": ["identity", "nope"]})
+    assert response.status_code == 400
+    assert "nope" in response.json()["detail"]
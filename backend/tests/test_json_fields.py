@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import server
+
+
+def feed_in_chunks(text, size):
+    parser = server.IncrementalJSONFields()
+    emitted = []
+    for i in range(0, len(text), size):
+        emitted.extend(parser.feed(text[i:i + size]))
+    emitted.extend(parser.finish())
+    return parser, emitted
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_fields_are_emitted_as_they_complete(size):
+    document = {"mission": "Build, \"ship\" {and} learn", "values": ["a", "b]"], "nested": {"x": [1, {"y": 2}]}, "score": 3}
+    parser, emitted = feed_in_chunks(json.dumps(document), size)
+    assert [field["key"] for field in emitted] == list(document)
+    assert all(field["status"] == "ok" for field in emitted)
+    assert parser.content() == document
+    assert parser.done
+
+
+def test_field_is_emitted_before_the_object_closes():
+    parser = server.IncrementalJSONFields()
+    assert parser.feed('{"a": "one", "b": ') == [{"key": "a", "value": "one", "status": "ok"}]
+    assert parser.feed('"tw') == []
+    assert parser.feed('o"}') == [{"key": "b", "value": "two", "status": "ok"}]
+
+
+def test_text_before_the_object_is_skipped():
+    parser, _ = feed_in_chunks('Here you go:\n```json\n{"a": 1}\n```', 4)
+    assert parser.content() == {"a": 1}
+
+
+def test_truncated_string_is_repaired_on_finish():
+    parser, emitted = feed_in_chunks('{"a": "done", "b": "cut off mid', 5)
+    assert emitted[-1] == {"key": "b", "value": "cut off mid", "status": "repaired"}
+    assert parser.content() == {"a": "done", "b": "cut off mid"}
+
+
+def test_truncated_nested_value_is_repaired_on_finish():
+    parser, emitted = feed_in_chunks('{"a": 1, "b": {"list": [1, 2, ', 5)
+    assert emitted[-1] == {"key": "b", "value": {"list": [1, 2]}, "status": "repaired"}
+
+
+def test_unrepairable_field_is_kept_raw():
+    parser, emitted = feed_in_chunks('{"a": tru, "b": 2}', 3)
+    assert emitted[0] == {"key": "a", "value": "tru", "status": "malformed"}
+    assert parser.malformed_fields() == ["a"]
+    assert parser.content()["b"] == 2
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('[1, 2,]', [1, 2]),
+    ('{"a": 1,}', {"a": 1}),
+    ('{"a": [1, {"b": "x', {"a": [1, {"b": "x"}]}),
+    ('"unterminated', "unterminated"),
+    ("'single quoted'", "single quoted"),
+    ('{"a": "brace } in string", "b": [', {"a": "brace } in string", "b": []}),
+])
+def test_repair_json_fragment(raw, expected):
+    assert json.loads(server.repair_json_fragment(raw)) == expected
+
+
+def test_parse_layer_content_salvages_intact_fields():
+    result = server.parse_layer_content('{"mission": "m", "vision": tru, "values": ["a", "b"')
+    assert result["content"] == {"mission": "m", "vision": "tru", "values": ["a", "b"]}
+    assert result["malformed_fields"] == ["vision"]
+
+
+def test_parse_layer_content_keeps_non_json_as_raw():
+    assert server.parse_layer_content("no json here") == {"content": {"raw_content": "no json here"}}
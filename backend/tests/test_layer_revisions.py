@@ -0,0 +1,75 @@
+import copy
+
+import pytest
+
+import server
+
+PAIRS = [
+    ({}, {}),
+    ({}, {"a": 1}),
+    ({"a": 1}, {}),
+    ({"a": 1, "b": "x"}, {"a": 2, "b": "x"}),
+    ({"a": {"b": {"c": 1, "d": 2}}}, {"a": {"b": {"c": 1, "e": 3}}}),
+    ({"a": [1, 2, 3]}, {"a": [1, 3]}),
+    ({"a": {"b": 1}}, {"a": [1]}),
+    ({"a": [1]}, {"a": {"b": 1}}),
+    ({"a": None}, {"a": {"b": None}}),
+    ({"a.b": 1, "$c": 2}, {"a.b": 2}),
+    ({"a": 1}, "replaced"),
+    ("text", {"a": 1}),
+]
+
+
+@pytest.mark.parametrize("old, new", PAIRS)
+def test_diff_round_trips(old, new):
+    ops = server.json_diff(old, new)
+    assert server.apply_json_diff(copy.deepcopy(old), ops) == new
+
+
+def test_unchanged_content_has_no_ops():
+    content = {"a": {"b": [1, 2]}, "c": "x"}
+    assert server.json_diff(content, copy.deepcopy(content)) == []
+
+
+def test_diff_touches_only_changed_keys():
+    old = {"big": "x" * 1000, "nested": {"keep": "y" * 1000, "change": 1}}
+    new = {"big": "x" * 1000, "nested": {"keep": "y" * 1000, "change": 2}, "added": True}
+    ops = server.json_diff(old, new)
+    assert sorted(op["path"] for op in ops) == [["added"], ["nested", "change"]]
+
+
+def test_chained_diffs_rebuild_every_version():
+    versions = [{}, {"a": 1}, {"a": 1, "b": {"c": [1]}}, {"b": {"c": [1, 2]}}, {"b": {"d": "x"}}, {}]
+    diffs = [server.json_diff(old, new) for old, new in zip(versions, versions[1:])]
+    content = {}
+    for ops, expected in zip(diffs, versions[1:]):
+        content = server.apply_json_diff(content, ops)
+        assert content == expected
+
+
+def layer(content):
+    return {"content": content, "status": "in_progress", "progress_percent": 20}
+
+
+def test_small_change_is_stored_as_diff():
+    previous = {"mission": "x" * 500, "vision": "v1"}
+    doc = server.layer_revision_doc("u1", "identity", 3, previous, layer({**previous, "vision": "v2"}), "edit")
+    assert doc["kind"] == "diff"
+    assert "content" not in doc
+    assert doc["changes"] == 1
+    assert doc["size"] < server.json_size(previous)
+
+
+def test_large_change_is_stored_as_snapshot():
+    doc = server.layer_revision_doc("u1", "identity", 3, {"a": "old"}, layer({"b": "new"}), "edit")
+    assert doc["kind"] == "snapshot"
+    assert doc["content"] == {"b": "new"}
+    assert "ops" not in doc
+
+
+def test_snapshot_on_interval_and_when_forced():
+    previous = {"mission": "x" * 500, "vision": "v1"}
+    after = layer({**previous, "vision": "v2"})
+    every = server.LAYER_REVISION_SNAPSHOT_EVERY
+    assert server.layer_revision_doc("u1", "identity", every, previous, after, "edit")["kind"] == "snapshot"
+    assert server.layer_revision_doc("u1", "identity", 1, previous, after, "edit", snapshot=True)["kind"] == "snapshot"
@@ -0,0 +1,224 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def make_client(max_in_flight=1, max_queue=10, queue_wait=5.0):
+    return server.LLMClient(max_in_flight, max_queue, queue_wait, timeout=30.0, max_retries=0)
+
+
+def as_user(user_id):
+    server.llm_user.set(server.User(user_id=user_id, email=f"{user_id}@example.com", name=user_id))
+
+
+async def hold(client):
+    slot = client.slot()
+    await slot.__aenter__()
+    return slot
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def use_slot(client, user_id, order):
+    as_user(user_id)
+    async with client.slot():
+        order.append(user_id)
+
+
+def test_free_slot_is_taken_immediately():
+    async def run():
+        client = make_client(max_in_flight=2)
+        first = await hold(client)
+        second = await hold(client)
+        assert client.in_flight == 2
+        assert client.waiting == 0
+        await first.__aexit__(None, None, None)
+        await second.__aexit__(None, None, None)
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_release_hands_slot_to_waiter():
+    async def run():
+        client = make_client()
+        holder = await hold(client)
+        order = []
+        waiter = asyncio.create_task(use_slot(client, "u1", order))
+        await settle()
+        assert client.waiting == 1
+
+        await holder.__aexit__(None, None, None)
+        # The slot moves over without in_flight dropping to zero in between
+        assert client.in_flight == 1
+        assert client.waiting == 0
+        await waiter
+        assert order == ["u1"]
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def run():
+        client = make_client(max_queue=1, queue_wait=2.0)
+        holder = await hold(client)
+        waiter = asyncio.create_task(use_slot(client, "u1", []))
+        await settle()
+
+        with pytest.raises(HTTPException) as error:
+            await hold(client)
+        assert error.value.status_code == 503
+        assert error.value.headers["Retry-After"] == "2"
+        assert client.rejected == 1
+
+        await holder.__aexit__(None, None, None)
+        await waiter
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_queue_wait_timeout_rejects_and_cleans_up():
+    async def run():
+        client = make_client(queue_wait=0.01)
+        holder = await hold(client)
+
+        with pytest.raises(HTTPException) as error:
+            await use_slot(client, "u1", [])
+        assert error.value.status_code == 503
+        assert client.waiting == 0
+        assert not client._queues
+
+        await holder.__aexit__(None, None, None)
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_timeout_racing_handoff_passes_slot_on(monkeypatch):
+    real_wait_for = asyncio.wait_for
+    calls = []
+
+    async def late_timeout(future, timeout):
+        # The first waiter times out even though the slot reached it meanwhile
+        calls.append(future)
+        if len(calls) > 1:
+            return await real_wait_for(future, timeout)
+        await asyncio.sleep(0.05)
+        assert future.done()
+        raise asyncio.TimeoutError
+
+    monkeypatch.setattr(server.asyncio, "wait_for", late_timeout)
+
+    async def run():
+        client = make_client()
+        holder = await hold(client)
+        order = []
+        racer = asyncio.create_task(use_slot(client, "u1", order))
+        await settle()
+        follower = asyncio.create_task(use_slot(client, "u2", order))
+        await settle()
+        assert client.waiting == 2
+
+        await holder.__aexit__(None, None, None)
+        with pytest.raises(HTTPException):
+            await racer
+        await follower
+        assert order == ["u2"]
+        assert client.in_flight == 0
+        assert client.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_timeout_racing_handoff_without_followers_frees_slot(monkeypatch):
+    async def late_timeout(future, timeout):
+        await asyncio.sleep(0.05)
+        raise asyncio.TimeoutError
+
+    monkeypatch.setattr(server.asyncio, "wait_for", late_timeout)
+
+    async def run():
+        client = make_client()
+        holder = await hold(client)
+        racer = asyncio.create_task(use_slot(client, "u1", []))
+        await settle()
+        await holder.__aexit__(None, None, None)
+        with pytest.raises(HTTPException):
+            await racer
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        client = make_client()
+        holder = await hold(client)
+        order = []
+        cancelled = asyncio.create_task(use_slot(client, "u1", order))
+        await settle()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert client.waiting == 0
+        assert not client._queues
+
+        await holder.__aexit__(None, None, None)
+        assert client.in_flight == 0
+        assert order == []
+
+    asyncio.run(run())
+
+
+def test_cancel_after_handoff_passes_slot_on():
+    async def run():
+        client = make_client()
+        holder = await hold(client)
+        order = []
+        cancelled = asyncio.create_task(use_slot(client, "u1", order))
+        await settle()
+        follower = asyncio.create_task(use_slot(client, "u2", order))
+        await settle()
+
+        # Cancelled after the slot was handed over but before the task resumed.
+        # Python 3.11's wait_for swallows such a cancel and the task keeps the
+        # slot; later versions raise and the slot must pass to the follower.
+        await holder.__aexit__(None, None, None)
+        cancelled.cancel()
+        try:
+            await cancelled
+        except asyncio.CancelledError:
+            pass
+        await follower
+        assert order in (["u2"], ["u1", "u2"])
+        assert client.in_flight == 0
+        assert client.waiting == 0
+
+    asyncio.run(run())
+
+
+def test_waiters_are_served_round_robin_per_user():
+    async def run():
+        client = make_client(max_queue=20)
+        holder = await hold(client)
+        order = []
+        tasks = []
+        for user_id in ("heavy", "heavy", "heavy", "light", "other", "heavy"):
+            tasks.append(asyncio.create_task(use_slot(client, user_id, order)))
+            await settle()
+        assert client.waiting == 6
+
+        await holder.__aexit__(None, None, None)
+        await asyncio.gather(*tasks)
+        assert order == ["heavy", "light", "other", "heavy", "heavy", "heavy"]
+        assert client.in_flight == 0
+
+    asyncio.run(run())
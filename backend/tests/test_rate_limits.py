@@ -0,0 +1,40 @@
+import asyncio
+
+import server
+
+
+def take(limiter, cost, per_minute=6, burst=3):
+    return asyncio.run(limiter.take("user_1:generate", per_minute, burst, cost))
+
+
+def test_requests_within_burst_are_admitted():
+    limiter = server.TokenBucketLimiter(100, False, 5.0)
+    assert [take(limiter, 1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert take(limiter, 1) > 0
+
+
+def test_cost_above_burst_is_admitted_from_a_full_bucket():
+    limiter = server.TokenBucketLimiter(100, False, 5.0)
+    assert take(limiter, 6) == 0.0
+    # The overdraft is paid back before the next call: 4 tokens at 0.1 per second
+    retry_after = take(limiter, 1)
+    assert 39 < retry_after <= 40
+
+
+def test_cost_above_burst_waits_for_a_full_bucket():
+    limiter = server.TokenBucketLimiter(100, False, 5.0)
+    assert take(limiter, 1) == 0.0
+    retry_after = take(limiter, 6)
+    assert 9 < retry_after <= 10
+    assert limiter.limited == 1
+
+
+def test_free_user_can_generate_all_six_layers(api):
+    response = api.post("/api/generate/layers", json={})
+    assert response.status_code == 200
+    assert '"failed": []' in response.text
+
+    # The overdraft makes the next generate call wait, and says for how long
+    retry = api.post("/api/generate/layer-content", json={"layer_id": "identity", "prompt": "again"})
+    assert retry.status_code == 429
+    assert int(retry.headers["Retry-After"]) > 0
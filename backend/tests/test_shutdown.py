@@ -0,0 +1,20 @@
+import asyncio
+
+import server
+
+
+def test_shutdown_stops_background_loops(api):
+    services = list(server.service_tasks)
+    assert services
+    api.__exit__(None, None, None)
+    assert all(task.done() for task in services)
+    assert not server.background_tasks
+    assert not server.service_tasks
+
+
+def test_pending_chat_messages_are_written_at_shutdown(api):
+    message = {"message_id": "msg_last", "user_id": "user_1", "role": "user", "content": "bye", "created_at": server.message_timestamp()}
+    api.portal.call(server.chat_writer.add, message)
+    db = server.db
+    api.__exit__(None, None, None)
+    assert asyncio.run(db.chat_messages.count_documents({"message_id": "msg_last"})) == 1
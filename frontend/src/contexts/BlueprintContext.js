@@ -53,9 +53,10 @@ export const BlueprintProvider = ({ children }) => {
   const updateLayer = async (layerId, content, status) => {
     try {
       const response = await blueprintAPI.updateLayer(layerId, content, status)
+      const updated = response.data.layer
       setBlueprint(prev => ({
         ...prev,
-        layers: response.data.layers,
+        layers: prev.layers.map(layer => (layer.layer_id === updated.layer_id ? updated : layer)),
         updated_at: new Date().toISOString()
       }))
     } catch (err) {